@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+# Throughput benchmarks for the parse/format/print pipeline:
+#
+#   python bench_delta.py                      # print results
+#   python bench_delta.py --save bench/        # also store bench/<revision>.json
+#   python bench_delta.py --compare bench/abc123.json
+#
+# Inputs are synthetic but shaped like the real thing, and seeded so that
+# every run (and every revision) sees exactly the same lines.
+
+from __future__ import division, absolute_import, print_function
+
+import gc
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+import click
+
+import delta
+
+try:
+    import tracemalloc
+except ImportError:  # pragma no cover, python 2
+    tracemalloc = None
+
+
+def vmstat_ticks(ticks, lines=200, seed=1):
+    # /proc/vmstat: one name and one counter per line
+    rng = random.Random(seed)
+    names = [u'counter_{0}'.format(i) for i in range(lines)]
+    values = [rng.randrange(10 ** 9) for _ in names]
+    for _ in range(ticks):
+        values = [v + rng.randrange(1000) for v in values]
+        yield u''.join(u'{0} {1}\n'.format(n, v) for n, v in zip(names, values))
+
+
+def interrupts_ticks(ticks, cpus=64, irqs=100, seed=2):
+    # /proc/interrupts: an aligned counter per CPU and a description
+    rng = random.Random(seed)
+    counts = [[rng.randrange(10 ** 6) for _ in range(cpus)] for _ in range(irqs)]
+    header = u'      ' + u''.join(u'{0:>11}'.format(u'CPU{0}'.format(c)) for c in range(cpus)) + u'\n'
+    for _ in range(ticks):
+        lines = [header]
+        for irq, row in enumerate(counts):
+            for c in range(cpus):
+                row[c] += rng.randrange(50)
+            lines.append(u'{0:>4}: {1}  IR-PCI-MSI {2}-edge eth0-TxRx-{3}\n'.format(
+                irq, u' '.join(u'{0:>10}'.format(v) for v in row), 524288 + irq, irq))
+        yield u''.join(lines)
+
+
+def ethtool_ticks(ticks, queues=64, seed=3):
+    # ethtool -S: indented name: value pairs, many per queue
+    rng = random.Random(seed)
+    names = [u'NIC statistics:']
+    for q in range(queues):
+        for stat in (u'packets', u'bytes', u'drops', u'csum_err'):
+            names.append(u'     rx_queue_{0}_{1}'.format(q, stat))
+            names.append(u'     tx_queue_{0}_{1}'.format(q, stat))
+    values = [rng.randrange(10 ** 12) for _ in names]
+    for _ in range(ticks):
+        values = [v + rng.randrange(10 ** 5) for v in values]
+        lines = [names[0] + u'\n']
+        lines.extend(u'{0}: {1}\n'.format(n, v) for n, v in zip(names[1:], values[1:]))
+        yield u''.join(lines)
+
+
+def log_ticks(ticks, lines=200, seed=4):
+    # noisy logs: mostly recurring shapes, some one-off lines
+    rng = random.Random(seed)
+    shapes = [
+        u'{t:.6f} INFO request {a} took {b}ms status 200\n',
+        u'{t:.6f} WARN retry {a}/5 for job {b}\n',
+        u'{t:.6f} INFO cache hits {a} misses {b} ratio {r:.2f}\n',
+    ]
+    t = 1000.0
+    for _ in range(ticks):
+        out = []
+        for _ in range(lines):
+            t += rng.random()
+            if rng.random() < 0.05:
+                out.append(u'{0:.6f} ERROR unexpected token {1} at {2}:{3} near {4}\n'.format(
+                    t, rng.randrange(99), u'x' * rng.randrange(1, 9), rng.randrange(999), rng.randrange(10 ** 6)))
+            else:
+                out.append(rng.choice(shapes).format(t=t, a=rng.randrange(10000), b=rng.randrange(10000),
+                                                     r=rng.random()))
+        yield u''.join(out)
+
+
+WORKLOADS = {
+    u'vmstat': vmstat_ticks,
+    u'interrupts': interrupts_ticks,
+    u'ethtool': ethtool_ticks,
+    u'logs': log_ticks,
+}
+
+
+class NullWriter(object):
+    def write(self, s):
+        pass
+
+    def flush(self):
+        pass
+
+
+def make_parser():
+    return delta.Parser(use_colors=True)
+
+
+def make_printer():
+    return delta.Printer(NullWriter(), False, True, False, False)
+
+
+# every stage is (setup, body): only the body is timed and traced
+
+def setup_lines(chunks):
+    return make_parser(), [chunk.splitlines(True) for chunk in chunks]
+
+
+def bench_process(state):
+    parser, lines = state
+    for tick in lines:
+        for line in tick:
+            parser.process(line)
+
+
+def setup_chunks(chunks):
+    return make_parser(), chunks
+
+
+def bench_process_text(state):
+    parser, chunks = state
+    for chunk in chunks:
+        parser.process_text(chunk)
+
+
+def setup_results(chunks):
+    parser = make_parser()
+    return [parser.process_text(chunk) for chunk in chunks]
+
+
+def bench_format(results):
+    for tick in results:
+        for fmt, deltas, values in tick:
+            fmt.format(values if deltas is None else deltas)
+
+
+def bench_output(results):
+    printer = make_printer()
+    for tick in results:
+        printer.separator()
+        for result in tick:
+            printer.output(*result)
+    printer.finish()
+
+
+def setup_feed(chunks):
+    feed = []
+    for chunk in chunks:
+        feed.append(delta.separator)
+        feed.append(delta.Block(chunk))
+        feed.append(delta.idle)
+    return feed
+
+
+def bench_run(feed):
+    delta.run(iter(feed), make_parser(), make_printer())
+
+
+STAGES = [
+    (u'process', setup_lines, bench_process),
+    (u'process_text', setup_chunks, bench_process_text),
+    (u'format', setup_results, bench_format),
+    (u'output', setup_results, bench_output),
+    (u'run', setup_feed, bench_run),
+]
+
+
+def measure(setup, body, chunks, repeat):
+    best = None
+    for _ in range(repeat):
+        state = setup(chunks)
+        gc.collect()
+        start = time.time()
+        body(state)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    allocated = None
+    if tracemalloc is not None:
+        # a separate run, tracing slows everything down
+        state = setup(chunks)
+        gc.collect()
+        tracemalloc.start()
+        body(state)
+        allocated = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return best, allocated
+
+
+def revision():
+    try:
+        with open(os.devnull, u'w') as devnull:
+            rev = subprocess.check_output([u'git', u'rev-parse', u'--short', u'HEAD'], stderr=devnull)
+            dirty = subprocess.call([u'git', u'diff', u'--quiet', u'HEAD', u'--', u'delta.py'], stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        return u'unknown'
+    rev = rev.decode(u'ascii').strip()
+    return rev + u'-dirty' if dirty else rev
+
+
+@click.command()
+@click.option(u'--ticks', metavar=u'NUMBER', type=click.IntRange(2), default=50, help=u'Samples per workload')
+@click.option(u'--repeat', metavar=u'NUMBER', type=click.IntRange(1), default=3, help=u'Take the best of this many runs')
+@click.option(u'-w', u'--workload', u'workloads', type=click.Choice(sorted(WORKLOADS)), multiple=True,
+    help=u'Only run this workload (may be repeated)')
+@click.option(u'--save', metavar=u'DIR', type=click.Path(file_okay=False),
+    help=u'Store results as DIR/<git revision>.json')
+@click.option(u'--compare', metavar=u'FILE', type=click.File(u'r'), help=u'Show speed relative to stored results')
+def main(ticks, repeat, workloads, save, compare):
+    baseline = json.load(compare)[u'results'] if compare else {}
+    results = {}
+    for name in workloads or sorted(WORKLOADS):
+        chunks = list(WORKLOADS[name](ticks))
+        lines = sum(chunk.count(u'\n') for chunk in chunks)
+        for stage, setup, body in STAGES:
+            elapsed, allocated = measure(setup, body, chunks, repeat)
+            key = u'{0}/{1}'.format(name, stage)
+            results[key] = {
+                u'lines_per_sec': round(lines / elapsed),
+                u'peak_bytes': allocated,
+            }
+            line = u'{0:<24} {1:>12,} lines/s'.format(key, results[key][u'lines_per_sec'])
+            if allocated is not None:
+                line += u' {0:>14,} bytes peak'.format(allocated)
+            if key in baseline:
+                line += u'  x{0:.2f}'.format(results[key][u'lines_per_sec'] / baseline[key][u'lines_per_sec'])
+            click.echo(line)
+
+    if save:
+        if not os.path.isdir(save):
+            os.makedirs(save)
+        rev = revision()
+        path = os.path.join(save, u'{0}.json'.format(rev))
+        with io.open(path, u'w') as fp:
+            fp.write(json.dumps({
+                u'revision': rev,
+                u'python': sys.version.split()[0],
+                u'ticks': ticks,
+                u'results': results,
+            }, indent=2, sort_keys=True))
+        click.echo(u'saved {0}'.format(path))
+
+
+if __name__ == u'__main__':  # pragma: no cover
+    main()
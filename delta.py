@@ -3,18 +3,33 @@
 from __future__ import division, absolute_import, print_function
 
 import re
-import click
 import sys
 import time
 import subprocess
 import os
-import colors
 import string
+import math
 import locale
+import select
+import codecs
+import operator
+import heapq
+import struct
+import stat
+import errno
+from array import array
 try:
     from itertools import izip_longest
 except ImportError:  # pragma no cover, python 3
     from itertools import zip_longest as izip_longest
+try:
+    from collections import OrderedDict
+except ImportError:  # pragma no cover, python 2.6
+    from ordereddict import OrderedDict
+try:
+    from time import monotonic
+except ImportError:  # pragma no cover, python 2
+    from time import time as monotonic
 try:
     from io import UnsupportedOperation
 except ImportError:
@@ -22,7 +37,6 @@ except ImportError:
         pass
 
 if sys.version_info[0] == 2:
-    import codecs
     _, encoding = locale.getdefaultlocale()
     sys.stdout = codecs.getwriter(encoding)(sys.stdout)
 
@@ -33,6 +47,64 @@ if sys.version_info[0] == 2:
 
 
 separator = object()
+idle = object()
+
+
+class Timestamp(float):
+    pass
+
+
+class Marked(object):
+    # a delta adjusted (or only flagged) by the counter checks
+    pass
+
+
+class MarkedInt(Marked, int):
+    pass
+
+
+class MarkedFloat(Marked, float):
+    pass
+
+
+def marked(value, kind):
+    value = (MarkedFloat if isinstance(value, float) else MarkedInt)(value)
+    value.kind = kind
+    return value
+
+
+class Gone(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):  # pragma: no cover
+        return 'Gone({0!r})'.format(self.name)
+
+
+class WallTime(float):
+    pass
+
+
+class Block(object):
+    def __init__(self, text):
+        self.text = text
+
+    def __repr__(self):  # pragma: no cover
+        return 'Block({0!r})'.format(self.text)
+
+
+def text_items(text, blocks=False):
+    if blocks:
+        return [Block(text)] if text else []
+    return [line + u'\n' for line in text.splitlines()]
+
+
+class Source(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):  # pragma: no cover
+        return 'Source({0!r})'.format(self.name)
 
 
 class StringChunk(object):
@@ -51,16 +123,49 @@ class StringChunk(object):
                 wsp.append(' ')
         return self.__class__(''.join(wsp))
 
-    def format(self, values, use_colors=True):
-        return self.static_str
-
-    def as_regex(self):
-        return re.escape(self.static_str)
+    def as_template(self, index):
+        return self.static_str.replace(u'{', u'{{').replace(u'}', u'}}')
 
     def __repr__(self):  # pragma: no cover
         return "'{!r}'".format(self.static_str)
 
 
+GREEN = u'\x1b[32m'
+RED = u'\x1b[31m'
+YELLOW = u'\x1b[33m'
+RESET = u'\x1b[0m'
+
+
+# what --extended-numbers recognizes on top of plain decimals: a sign
+# (unless glued to a word, as in 2016-01-01 or eth-1), hex, scientific
+# notation and unit suffixes like 12.3K or 4GiB
+PLAIN_NUMBER = r'[0-9]+(?:\.[0-9]+)?'
+EXTENDED_NUMBER = (r'(?:(?<!\S)[-+])?(?:0[xX][0-9a-fA-F]+|[0-9]+(?:\.[0-9]+)?'
+                   r'(?:[eE][-+]?[0-9]+|(?:[kKMGTPE]i?B?|B)(?![A-Za-z]))?)')
+plain_number_re = re.compile(PLAIN_NUMBER + u'$')
+unit_re = re.compile(r'([kKMGTPE]?)(i?)B?$')
+exponent_re = re.compile(r'([eE])([-+]?)([0-9]+)$')
+
+
+def split_unit(n):
+    # 4GiB -> (u'4', u'GiB', 1024 ** 3)
+    m = unit_re.search(n)
+    prefix, binary = m.groups()
+    scale = (1024 if binary else 1000) ** u' KMGTPE'.index(prefix.upper() or u' ')
+    return n[:m.start()], n[m.start():], scale
+
+
+def parse_number(n):
+    # anything from EXTENDED_NUMBER that int() and float() do not take
+    if n.lstrip(u'+-')[:2] in (u'0x', u'0X'):
+        return int(n, 16)
+    number, unit, scale = split_unit(n)
+    if not unit:
+        # 1e3
+        return float(n)
+    return Parser.num(number) * scale
+
+
 class NumberChunk(object):
     @staticmethod
     def detect(spaces, n, first, flex=True):
@@ -76,6 +181,9 @@ class NumberChunk(object):
         elif first:
             align = u''
 
+        if not plain_number_re.match(n):
+            return NumberChunk.detect_extended(prefix, align, plus, width, n, flex)
+
         if u'.' not in n:
             if align == u'' and flex and width < 2:
                 width = 2
@@ -94,119 +202,709 @@ class NumberChunk(object):
             align = u''
         return NumberChunk(prefix, align, plus, width, u'.%df' % len(frac))
 
-    def __init__(self, prefix, align, plus, width, fmt):
+    @staticmethod
+    def detect_extended(prefix, align, plus, width, n, flex):
+        # keep the look of the original: deltas of hex numbers are shown
+        # in hex, of 1.5e3 in scientific notation and of 4GiB in GiB, and
+        # the original number comes out exactly as it went in
+        body = n.lstrip(u'+-')
+        signed = n.startswith(u'+')
+        if body[:2] in (u'0x', u'0X'):
+            digits = body[2:]
+            if digits.upper() != digits:
+                case = u'x'
+            elif digits.lower() != digits:
+                case = u'X'
+            else:
+                case = body[1]
+            return NumberChunk(prefix, align, plus, width, case, alt=u'#', signed=signed,
+                               hex_x=body[1] if body[1] != case else None)
+        m = exponent_re.search(body)
+        if m is not None:
+            # an E followed by digits, not the exa in 1E or 4EiB
+            decimals = len(body[:m.start()].partition(u'.')[2])
+            return NumberChunk(prefix, align, plus, width, u'.%d%s' % (decimals, m.group(1)), signed=signed,
+                               exponent=(len(m.group(3)), m.group(2) == u'+'))
+
+        number, suffix, scale = split_unit(body)
+        width -= len(suffix)
+        fmt = u''
+        if u'.' in number:
+            fmt = u'.%df' % len(number.partition(u'.')[2])
+        if align == u'' and flex and width < 2:
+            width = 2
+        return NumberChunk(prefix, align, plus, width, fmt, suffix=suffix, scale=scale, signed=signed)
+
+    def __init__(self, prefix, align, plus, width, fmt, alt=u'', suffix=u'', scale=1, signed=False, hex_x=None,
+                 exponent=None):
         self.prefix = prefix
         self.align = align
         self.plus = plus
         self.width = width
         self.fmt = fmt
+        self.alt = alt
+        self.suffix = suffix
+        self.scale = scale
+        # an explicit + on the original, kept when showing values as they are
+        self.signed = signed
+        # what format() cannot do by itself: 0x with upper case digits (or
+        # the other way round) and exponents as short as e3
+        self.hex_x = hex_x
+        self.exponent = exponent
+        self.template = self.as_template(0)
+        # colored variants, so that coloring a value is just picking one
+        self.green = GREEN + self.template + RESET
+        self.red = RED + self.template + RESET
+        self.restyled = hex_x is not None or exponent is not None
+        if self.restyled:
+            self.bare = u'{0:%s%s%s}' % (plus, alt, fmt)
+        # hex only takes integers, while rates and averages may not be
+        self.decimal = NumberChunk(prefix, align, plus, width, u'') if alt else None
 
     def plain(self):
-        return self.__class__(self.prefix, self.align, u'', self.width, self.fmt)
+        return self.__class__(self.prefix, self.align, u'+' if self.signed else u'', self.width, self.fmt, self.alt,
+                              self.suffix, self.scale, self.signed, self.hex_x, self.exponent)
+
+    def scaled(self, value):
+        value = value / self.scale
+        if value == int(value):
+            return int(value)
+        return round(value, 2)
 
     def whitespace(self):
         return self
 
     def format_str(self):
-        return u'%s{0:%s%s%s%s}' % (self.prefix, self.align, self.plus, self.width, self.fmt)
+        return self.template
 
     def __repr__(self):  # pragma: no cover
-        return self.format_str()
-
-    @staticmethod
-    def colorize(val, s):
-        if val is not None:
-            if val > 0:
-                return colors.green(s)
-            elif val < 0:
-                return colors.red(s)
-        return s
-
-    def format(self, values, use_colors=True):
-        value = values.pop(0)
-        s = self.format_str().format(value)
-        if use_colors:
-            s = self.colorize(value, s)
-        return s
-
-    def as_regex(self):
-        return r'(\s*[0-9]+(?:\.[0-9]+)?)'
+        return self.template
+
+    def color_template(self, value):
+        if value > 0:
+            return self.green
+        elif value < 0:
+            return self.red
+        return self.template
+
+    def render(self, value, use_colors=True):
+        shown = value
+        if self.scale != 1:
+            shown = self.scaled(value)
+        elif self.decimal is not None and isinstance(value, float):
+            if not value.is_integer():
+                return self.decimal.render(value, use_colors)
+            shown = int(value)
+        if self.restyled:
+            text = self.restyle(shown)
+            if use_colors and value:
+                return (GREEN if value > 0 else RED) + text + RESET
+            return text
+        template = self.color_template(value) if use_colors else self.template
+        return template.format(shown)
+
+    def restyle(self, value):
+        text = self.bare.format(value)
+        if self.hex_x is not None:
+            zero = text.index(u'0')
+            text = text[:zero + 1] + self.hex_x + text[zero + 2:]
+        if self.exponent is not None and u'e' in text.lower():
+            # not for inf or nan
+            digits, plus = self.exponent
+            mantissa, e, exponent = text.rpartition(self.fmt[-1])
+            sign = exponent[0] if exponent[0] == u'-' or plus else u''
+            text = u'{0}{1}{2}{3}'.format(mantissa, e, sign, exponent[1:].lstrip(u'0').zfill(digits))
+        pad = int(self.width) - len(text)
+        if pad > 0:
+            text = text + u' ' * pad if self.align == u'<' else u' ' * pad + text
+        return self.prefix + text + self.suffix
+
+    def as_template(self, index):
+        return u'%s{%d:%s%s%s%s%s}%s' % (self.prefix, index, self.align, self.plus, self.alt, self.width, self.fmt,
+                                         self.suffix)
 
 
 class Format(object):
     def __init__(self, chunks, colors=True):
         self.chunks = chunks
         self.colors = colors
-        self.regex = re.compile(''.join(c.as_regex() for c in self.chunks))
+        self.numbers = []
+        template = []
+        color_template = []
+        for chunk in chunks:
+            if isinstance(chunk, NumberChunk):
+                index = len(self.numbers)
+                template.append(chunk.as_template(index))
+                color_template.append(u'{%d}' % index)
+                self.numbers.append(chunk)
+            else:
+                template.append(chunk.as_template(None))
+                color_template.append(template[-1])
+        self.template = u''.join(template)
+        # colored numbers are rendered one by one and pasted into here
+        self.color_template = u''.join(color_template)
+        self.color_templates = [(number.template, number.green, number.red) for number in self.numbers]
+        # numbers with unit suffixes are shown in their original unit and
+        # hex ones in hex, which takes a look at every value
+        self.converted = any(number.scale != 1 or number.decimal is not None or number.restyled
+                             for number in self.numbers)
+        self._plain = None
+        self._whitespace = None
+        self._key = None
+
+    @property
+    def key(self):
+        # the line with {} in place of every number, e.g. for machine readable output
+        if self._key is None:
+            key = u''.join(u'{}' if isinstance(c, NumberChunk) else c.static_str for c in self.chunks)
+            self._key = key.rstrip(u'\n')
+        return self._key
 
     def plain(self):
-        return self.__class__([c.plain() for c in self.chunks], False)
+        # variants are built on first use and reused for every later line
+        if self._plain is None:
+            self._plain = self.__class__([c.plain() for c in self.chunks], False)
+            self._plain._plain = self._plain
+        return self._plain
 
     def whitespace(self):
-        return self.__class__([c.whitespace() for c in self.chunks], self.colors)
-
-    def format_values(self, values, use_colors):
-        values = list(values)
-        if use_colors is None: use_colors = self.colors
-        for chunk in self.chunks:
-            yield chunk.format(values, use_colors)
+        if self._whitespace is None:
+            self._whitespace = self.__class__([c.whitespace() for c in self.chunks], self.colors)
+            self._whitespace._whitespace = self._whitespace
+        return self._whitespace
 
     def format(self, values, use_colors=None):
-        return ''.join(self.format_values(values, use_colors))
+        if use_colors is None: use_colors = self.colors
+        if self.converted:
+            return self.format_converted(values, use_colors)
+        if not use_colors:
+            return self.template.format(*values)
+        return self.color_template.format(*[
+            (green if value > 0 else red if value < 0 else plain).format(value)
+            for (plain, green, red), value in zip(self.color_templates, values)])
+
+    def format_converted(self, values, use_colors):
+        return self.color_template.format(*[
+            number.render(value, use_colors) for number, value in zip(self.numbers, values)])
+
+    def format_marked(self, values):
+        # like format(), but deltas flagged by the counter checks stand out
+        if not self.colors:
+            return self.format(values)
+        return self.color_template.format(*[
+            YELLOW + number.render(value, False) + RESET if isinstance(value, Marked) else number.render(value)
+            for number, value in zip(self.numbers, values)])
 
     def __repr__(self):  # pragma: no cover
         return repr(self.chunks)
 
 
+class Layout(object):
+    def __init__(self, skeleton, entries, engine, prev, time):
+        self.skeleton = skeleton
+        self.entries = entries
+        self.engine = engine
+        self.prev = prev
+        self.time = time
+
+
+class Window(object):
+    # the last `size` deltas of every number in a format, kept in one
+    # preallocated array, a row per sample: memory stays the same however
+    # long delta runs
+    STATS = (u'avg', u'min', u'max', u'p50', u'p99')
+
+    def __init__(self, slots, size):
+        self.slots = slots
+        self.size = size
+        self.ring = array('d', [0.0]) * (slots * size)
+        self.pos = 0
+        self.count = 0
+
+    def add(self, deltas):
+        ring = self.ring
+        base = self.pos * self.slots
+        for i, d in enumerate(deltas):
+            ring[base + i] = d
+        self.pos = (self.pos + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def column(self, i):
+        return self.ring[i:self.count * self.slots:self.slots]
+
+    @staticmethod
+    def number(value):
+        if value.is_integer():
+            return int(value)
+        return round(value, 2)
+
+    def stat(self, name):
+        count = self.count
+        if name == u'avg':
+            return [self.number(sum(self.column(i)) / count) for i in range(self.slots)]
+        if name == u'min':
+            return [self.number(min(self.column(i))) for i in range(self.slots)]
+        if name == u'max':
+            return [self.number(max(self.column(i))) for i in range(self.slots)]
+        # nearest rank percentile
+        rank = int(math.ceil(int(name[1:]) / 100 * count)) - 1
+        return [self.number(sorted(self.column(i))[rank]) for i in range(self.slots)]
+
+
+class ListEngine(object):
+    def parse(self, numbers):
+        return Parser.nums(numbers)
+
+    def array(self, values):
+        return values
+
+    def subtract(self, new, old):
+        return list(map(operator.sub, new, old))
+
+    def rates(self, deltas, elapsed):
+        return Parser.rates(deltas, elapsed)
+
+    def tolist(self, values):
+        return values
+
+
+class NumpyEngine(ListEngine):
+    # only handles integers that safely fit into int64, anything
+    # else makes the caller fall back to ListEngine
+    max_digits = 18
+
+    def __init__(self):
+        import numpy
+        self.numpy = numpy
+
+    def parse(self, numbers):
+        if not numbers:
+            return self.numpy.zeros(0, dtype=self.numpy.int64)
+        text = u' '.join(numbers)
+        if u'.' in text or max(map(len, numbers)) > self.max_digits:
+            return None
+        return self.numpy.fromstring(text, dtype=self.numpy.int64, sep=u' ')
+
+    def array(self, values):
+        limit = 10 ** self.max_digits
+        if not all(isinstance(v, int) and -limit < v < limit for v in values):
+            return None
+        return self.numpy.array(values, dtype=self.numpy.int64)
+
+    def subtract(self, new, old):
+        return new - old
+
+    def rates(self, deltas, elapsed):
+        if elapsed <= 0:
+            return deltas
+        return self.numpy.round(deltas / elapsed, 2)
+
+    def tolist(self, values):
+        return values.tolist()
+
+
+def default_engine():
+    try:
+        return NumpyEngine()
+    except ImportError:
+        return ListEngine()
+
+
 class Parser(object):
-    def __init__(self, flex=True, absolute=False, use_colors=True):
+    # spaces before a number never include a newline, so the same regex
+    # works on a single line and on a whole chunk of lines at once
+    number_re = re.compile(r'([^\S\n]*)(%s)' % PLAIN_NUMBER)
+    extended_number_re = re.compile(r'([^\S\n]*)(%s)' % EXTENDED_NUMBER)
+    blank_re = re.compile(r'[^\S\n]+')
+
+    def __init__(self, flex=True, absolute=False, use_colors=True, max_formats=None, rate=False, engine=None,
+                 window=None, counters=None, extended=False, key_columns=(), key_regex=None):
         self.values = {}
+        self.times = {}
+        # how long the latest deltas of every format took, for rates
+        self.intervals = {}
+        self.window = window
+        self.windows = {}
+        self.counters = counters
+        self.layouts = {}
+        self.engine = engine
+        if extended:
+            self.number_re = self.extended_number_re
+            if engine is None:
+                # NumpyEngine only reads plain integers
+                self.engine = ListEngine()
+        self.key_re = self.make_key_re(key_columns, key_regex)
+        # keys of table rows seen in the previous and in the current tick
+        self.rows = set()
+        self.seen = set()
+        self.timestamp = None
+        self.elapsed = None
+        self.source = None
+        self.formats = OrderedDict()
         self.flex = flex
         self.absolute = absolute
         self.use_colors = use_colors
+        self.max_formats = max_formats
+        self.rate = rate
+        self.evicted = 0
 
     @staticmethod
     def num(n):
-        if u'.' not in n:
-            return int(n)
-        return float(n)
+        try:
+            if u'.' not in n:
+                return int(n)
+            return float(n)
+        except ValueError:
+            return parse_number(n)
+
+    @classmethod
+    def nums(cls, numbers):
+        try:
+            return list(map(int, numbers))
+        except ValueError:
+            return [cls.num(n) for n in numbers]
 
     @staticmethod
     def grouper(iterable, n, fillvalue=None):
         args = [iter(iterable)] * n
         return izip_longest(*args, fillvalue=fillvalue)
 
-    def parse(self, line):
+    @staticmethod
+    def skeleton(elts):
+        # re.split returns [text, spaces, number, text, ..., text], so every
+        # third element is the static text between numbers; NUL marks where
+        # the numbers were, the trailing newline is not part of the shape
+        skeleton = u'\0'.join(elts[::3])
+        if u'\1' in skeleton or skeleton.count(u'\0') != len(elts) // 3:
+            # NULs in the text itself are escaped, so they never pass for numbers
+            skeleton = u'\0'.join(e.replace(u'\1', u'\1\1').replace(u'\0', u'\1\2') for e in elts[::3])
+        return skeleton.rstrip(u'\n')
+
+    def key(self, skeleton):
+        if self.source is None:
+            return skeleton
+        return self.source, skeleton
+
+    @staticmethod
+    def make_key_re(columns, regex):
+        if regex is not None:
+            return re.compile(regex)
+        if not columns:
+            return None
+        # whitespace separated columns, capturing the key ones
+        return re.compile(r'^[^\S\n]*' + r'[^\S\n]+'.join(
+            r'(\S+)' if i in columns else r'\S+' for i in range(1, max(columns) + 1)))
+
+    def split_keyed(self, line):
+        # like number_re.split(), but numbers in the key are kept as text,
+        # so the key ends up in the skeleton and every row gets its own format
+        m = self.key_re.search(line)
+        if m is None:
+            return self.number_re.split(line), False
+        groups = range(1, len(m.groups()) + 1) if m.groups() else [0]
+        elts = [u'']
+        pos = 0
+        for group in groups:
+            start, end = m.span(group)
+            if start < pos:
+                continue
+            part = self.number_re.split(line[pos:start])
+            elts[-1] += part[0]
+            elts.extend(part[1:])
+            elts[-1] += line[start:end]
+            pos = end
+        part = self.number_re.split(line[pos:])
+        elts[-1] += part[0]
+        elts.extend(part[1:])
+        return elts, True
+
+    def tick(self):
+        # forget table rows that did not show up since the last tick
+        if self.key_re is None:
+            return
+        for key in self.rows.difference(self.seen):
+            self.drop(key)
+        self.rows, self.seen = self.seen, set()
+
+    def parse(self, line, elts=None, key=None):
         values = []
         chunks = []
 
-        elts = re.split(r'(\s*)([0-9]+(?:\.[0-9]+)?)', line)
+        if elts is None:
+            elts = self.number_re.split(line)
         for i, (prefix, spaces, number) in enumerate(self.grouper(elts, 3)):
             if prefix:
                 chunks.append(StringChunk(prefix))
             if number is not None:
                 values.append(self.num(number))
                 chunks.append(NumberChunk.detect(spaces, number, i==0 and not prefix))
-                
+
         fmt = Format(chunks, self.use_colors)
+        if key is None:
+            key = self.key(self.skeleton(elts))
+        self.formats[key] = fmt
         self.values[fmt] = values
+        self.times[fmt] = self.now()
+        self.elapsed = None
+        if self.max_formats and len(self.formats) > self.max_formats:
+            self.evict()
         return fmt.plain(), None, values
 
+    def evict(self):
+        _, fmt = self.formats.popitem(last=False)
+        del self.values[fmt]
+        del self.times[fmt]
+        self.intervals.pop(fmt, None)
+        self.windows.pop(fmt, None)
+        self.evicted += 1
+
+    def forget(self, source):
+        self.layouts.pop(source, None)
+        for key in [k for k in self.formats if isinstance(k, tuple) and k[0] == source]:
+            self.drop(key)
+
+    def drop(self, key):
+        fmt = self.formats.pop(key, None)
+        if fmt is not None:
+            del self.values[fmt]
+            del self.times[fmt]
+            self.intervals.pop(fmt, None)
+            self.windows.pop(fmt, None)
+
+    def update(self, key, fmt, values):
+        if self.max_formats:
+            # keep self.formats in least recently used first order
+            self.formats[key] = self.formats.pop(key)
+
+        deltas = [n-o for n, o in zip(values, self.values[fmt])]
+        now = self.now()
+        self.elapsed = self.intervals[fmt] = now - self.times[fmt]
+        if not self.absolute:
+            self.values[fmt] = values
+            self.times[fmt] = now
+        if self.counters:
+            deltas = self.check_counters(deltas, values)
+        elif self.rate:
+            deltas = self.rates(deltas, self.elapsed)
+        if self.window:
+            self.add_to_window(fmt, deltas)
+        return fmt, deltas, values
+
+    COUNTER_MARKS = {u'ignore': u'drop', u'wrap': u'wrap', u'reset': u'reset'}
+
+    def check_counters(self, deltas, values):
+        # integers that go down are taken to be counters that wrapped
+        # around or were reset, and the delta is marked as such
+        rate = self.rate and self.elapsed > 0
+        result = []
+        for d, v in zip(deltas, values):
+            kind = None
+            if d < 0 and not isinstance(d, float):
+                kind = self.COUNTER_MARKS[self.counters]
+                if self.counters == u'reset':
+                    # counting up from zero again
+                    d = v
+                elif self.counters == u'wrap':
+                    old = v - d
+                    bits = 32 if old < 2 ** 32 else 64 if old < 2 ** 64 else None
+                    if bits is None:
+                        kind = u'drop'
+                    elif d + 2 ** bits < 2 ** (bits - 2):
+                        # close enough to the top of the range to have wrapped
+                        d += 2 ** bits
+                    else:
+                        # anything else would be a made up jump of up to 2^64
+                        kind = u'reset'
+                        d = v
+            if rate:
+                d = d / self.elapsed if isinstance(d, float) else round(d / self.elapsed, 2)
+            if kind is not None:
+                d = marked(d, kind)
+            result.append(d)
+        return result
+
+    def add_to_window(self, fmt, deltas):
+        window = self.windows.get(fmt)
+        if window is None:
+            window = self.windows[fmt] = Window(len(deltas), self.window)
+        window.add(deltas)
+
     def process(self, line):
-        for fmt, old_values in self.values.items():
-            m = fmt.regex.match(line)
-            if m:
-                values = [self.num(v) for v in m.groups()]
-                deltas = [n-o for n, o in zip(values, old_values)]
-                if not self.absolute:
-                    self.values[fmt] = values
-                return fmt, deltas, values
+        if self.layouts:
+            self.spill()
+        if self.key_re is None:
+            elts = self.number_re.split(line)
+            key = self.key(self.skeleton(elts))
+        else:
+            elts, keyed = self.split_keyed(line)
+            skeleton = self.skeleton(elts)
+            if keyed:
+                # a re-padded table is still the same rows
+                skeleton = self.blank_re.sub(u' ', skeleton).lstrip(u' ')
+            key = self.key(skeleton)
+            if keyed:
+                self.seen.add(key)
+        fmt = self.formats.get(key)
+        if fmt is None:
+            return self.parse(line, elts, key)
+        return self.update(key, fmt, [self.num(v) for v in elts[2::3]])
+
+    def process_text(self, text):
+        if self.timestamp is not None:
+            return self.process_chunk(text)
+        # all lines of a chunk are one sample, taken at one time
+        self.timestamp = Timestamp(monotonic())
+        try:
+            return self.process_chunk(text)
+        finally:
+            self.timestamp = None
+
+    def process_chunk(self, text):
+        if u'\0' in text or u'\1' in text or self.key_re is not None:
+            # lines that need escaping, or keying, are done one by one
+            self.spill()
+            return [self.process(line) for line in text.splitlines(True)]
+
+        elts = self.number_re.split(text)
+        skeleton = u'\0'.join(elts[::3])
+        layout = self.layouts.get(self.source)
+        if layout is not None and layout.skeleton == skeleton and self.layout_alive(layout):
+            return self.update_layout(layout, elts[2::3])
+        self.spill()
+
+        # one scan over the whole chunk, then slice the numbers and
+        # skeletons up per line without looking at every number again
+        values = self.nums(elts[2::3])
+        skeletons = skeleton.split(u'\n')
+        if not skeletons[-1]:
+            skeletons.pop()
+
+        results = []
+        entries = []
+        lines = None
+        pos = 0
+        for i, line_skeleton in enumerate(skeletons):
+            n = line_skeleton.count(u'\0')
+            key = self.key(line_skeleton)
+            fmt = self.formats.get(key)
+            if fmt is None:
+                if lines is None:
+                    lines = text.split(u'\n')
+                results.append(self.parse(lines[i] + u'\n'))
+                fmt = self.formats.get(key)
+            else:
+                results.append(self.update(key, fmt, values[pos:pos + n]))
+            entries.append((key, fmt, pos, pos + n))
+            pos += n
+
+        self.make_layout(skeleton, entries)
+        return results
+
+    def make_layout(self, skeleton, entries):
+        fmts = [fmt for _, fmt, _, _ in entries]
+        if None in fmts or len(set(fmts)) != len(fmts):
+            return
+        if any(fmt not in self.times for fmt in fmts):
+            # evicted again further down the same chunk
+            return
+        times = set(self.times[fmt] for fmt in fmts)
+        if len(times) != 1:
+            return
+
+        prev = []
+        for fmt in fmts:
+            prev.extend(self.values[fmt])
+        # the engine is picked when the layout is first reused, so that a
+        # single sample does not pay for importing numpy
+        self.layouts[self.source] = Layout(skeleton, entries, None, prev, times.pop())
+
+    def load_layout(self, layout):
+        if self.engine is None:
+            self.engine = default_engine()
+        array = self.engine.array(layout.prev)
+        if array is None:
+            layout.engine = ListEngine()
+        else:
+            layout.engine = self.engine
+            layout.prev = array
+
+    def layout_alive(self, layout):
+        if not self.max_formats:
+            return True
+        return all(key in self.formats for key, _, _, _ in layout.entries)
+
+    def update_layout(self, layout, numbers):
+        # the chunk has exactly the same lines as last time, so the numbers
+        # line up with the stored ones and all deltas are one subtraction
+        if layout.engine is None:
+            self.load_layout(layout)
+        values = layout.engine.parse(numbers)
+        if values is None:
+            layout.engine = ListEngine()
+            layout.prev = layout.prev.tolist()
+            values = layout.engine.parse(numbers)
+        engine = layout.engine
+
+        now = self.now()
+        deltas = engine.subtract(values, layout.prev)
+        self.elapsed = now - layout.time
+        if not self.absolute:
+            layout.prev = values
+            layout.time = now
+        if self.counters:
+            values = engine.tolist(values)
+            deltas = self.check_counters(engine.tolist(deltas), values)
+        else:
+            if self.rate:
+                deltas = engine.rates(deltas, self.elapsed)
+            deltas = engine.tolist(deltas)
+            values = engine.tolist(values)
+
+        intervals = self.intervals
+        for _, fmt, _, _ in layout.entries:
+            intervals[fmt] = self.elapsed
+        if self.max_formats:
+            for key, _, _, _ in layout.entries:
+                self.formats[key] = self.formats.pop(key)
+        if self.window:
+            for _, fmt, start, end in layout.entries:
+                self.add_to_window(fmt, deltas[start:end])
+        return [(fmt, deltas[start:end], values[start:end]) for _, fmt, start, end in layout.entries]
+
+    def spill(self):
+        # hand the state kept in the current source's layout back to
+        # the formats, so that they can be processed one by one again
+        layout = self.layouts.pop(self.source, None)
+        if layout is None:
+            return
+        prev = layout.prev if layout.engine is None else layout.engine.tolist(layout.prev)
+        for _, fmt, start, end in layout.entries:
+            if fmt in self.values:
+                self.values[fmt] = prev[start:end]
+                self.times[fmt] = layout.time
 
-        return self.parse(line)
+    def now(self):
+        if self.timestamp is None:
+            return monotonic()
+        return self.timestamp
+
+    def rates_of(self, fmt, deltas):
+        # deltas are only ever handed out for formats seen at least twice
+        return self.rates(deltas, self.intervals[fmt])
+
+    @staticmethod
+    def rates(deltas, elapsed):
+        if elapsed <= 0:
+            # two samples taken at once, there is no rate to speak of
+            return deltas
+        return [d / elapsed if isinstance(d, float) else round(d / elapsed, 2) for d in deltas]
 
 
 class Printer(object):
-    def __init__(self, fp, timestamps, separators, orig, skip_zeros):
+    def __init__(self, fp, timestamps, separators, orig, skip_zeros, batch=False, max_delay=0.1,
+                 buffer_size=65536, top=None, windows=None, stats=(), stats_only=False,
+                 marks=False):
         self.fp = fp
         self.timestamps = timestamps
         self.separators = separators
@@ -215,12 +913,33 @@ class Printer(object):
         self.separators_pending = 0
         self.lines_since_sep = 0
         self.multiline = False
+        self.batch = batch
+        self.max_delay = max_delay
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+        self.buffered_since = None
+        self.label = None
+        self.top = top
+        self.ranked = []
+        self.seq = 0
+        # set when replaying a recording, so that output shows the time of capture
+        self.wall_time = None
+        self.windows = windows
+        self.stats = stats
+        self.stats_only = stats_only
+        self.marks = marks
 
-    @classmethod
     def now(self):  # pragma: no cover
-        return time.asctime()
+        if self.wall_time is None:
+            return time.asctime()
+        return time.asctime(time.localtime(self.wall_time))
 
     def separator(self):
+        if self.ranked:
+            self.output_ranked()
+        if self.buffer:
+            self.flush()
         if self.separators:
             if self.lines_since_sep == 1:
                 self.multiline = False
@@ -244,14 +963,34 @@ class Printer(object):
             return self.print_separator()
 
     def print_line(self, line):
+        if self.label is not None:
+            line = u'{0}: {1}'.format(self.label, line)
         if self.timestamps:
             return u'{0}: {1}'.format(self.now(), line)
         return line
 
     def print_chunks(self, chunks):
-        for buf in chunks:
-            self.fp.write(buf)
-        self.fp.flush()
+        if not self.batch:
+            for buf in chunks:
+                self.fp.write(buf)
+            self.fp.flush()
+            return
+
+        if not chunks:
+            return
+        if not self.buffer:
+            self.buffered_since = time.time()
+        self.buffer.extend(chunks)
+        self.buffered += sum(len(buf) for buf in chunks)
+        if self.buffered >= self.buffer_size or time.time() - self.buffered_since >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.fp.write(u''.join(self.buffer))
+            self.fp.flush()
+            self.buffer = []
+            self.buffered = 0
 
     def make_output(self, fmt, deltas, values):
         if deltas is None:
@@ -264,15 +1003,78 @@ class Printer(object):
             if len(values):
                 yield self.print_line(fmt.plain().format(values))
                 if not skip_delta:
-                    yield self.print_line(fmt.whitespace().format(deltas))
+                    yield self.print_line(self.format_deltas(fmt.whitespace(), deltas))
             else:
                 yield self.print_line(fmt.format(values))
-        else:
-            if not skip_delta:
-                yield self.print_line(fmt.format(deltas))
+        elif not skip_delta and not (self.stats_only and len(deltas)):
+            yield self.print_line(self.format_deltas(fmt, deltas))
+        if self.stats and not skip_delta:
+            for line in self.make_stats(fmt):
+                yield line
+
+    def format_deltas(self, fmt, deltas):
+        if self.marks:
+            kinds = sorted(set(d.kind for d in deltas if isinstance(d, Marked)))
+            if kinds:
+                return self.suffix(fmt.format_marked(deltas), u'[{0}]'.format(u','.join(kinds)))
+        return fmt.format(deltas)
+
+    @staticmethod
+    def suffix(line, text):
+        if line.endswith(u'\n'):
+            return u'{0} {1}\n'.format(line[:-1], text)
+        return u'{0} {1}'.format(line, text)
+
+    def make_stats(self, fmt):
+        # the parser's window for this format, including this sample
+        window = self.windows.get(fmt)
+        if window is None or not window.slots:
+            # nothing to take statistics of in a line without numbers
+            return
+        for name in self.stats:
+            yield self.print_line(self.suffix(fmt.format(window.stat(name)), name))
 
+    def rank(self, fmt, deltas, values):
+        # keep the N largest changes seen this tick in a min-heap, so each
+        # line costs O(log N); ties go to the line that came first
+        self.seq -= 1
+        if deltas is None:
+            # a first sample has not changed yet, so it only fills what room
+            # the changes leave (all of it on the first tick)
+            change = -1
+        else:
+            change = max(abs(d) for d in deltas) if len(deltas) else 0
+        item = (change, self.seq, self.label, fmt, deltas, values)
+        if len(self.ranked) < self.top:
+            heapq.heappush(self.ranked, item)
+        elif item[:2] > self.ranked[0][:2]:
+            heapq.heapreplace(self.ranked, item)
+
+    def output_ranked(self):
+        ranked, self.ranked = self.ranked, []
+        label = self.label
+        for _, _, self.label, fmt, deltas, values in sorted(ranked, key=lambda item: item[:2], reverse=True):
+            self.output_line(fmt, deltas, values)
+        self.label = label
+
+    def finish(self):
+        # the feed ended, so whatever was ranked so far is the last tick
+        if self.ranked:
+            self.output_ranked()
+        self.flush()
+
+    def idle(self):
+        # the feed is about to block, possibly in the middle of a tick, so
+        # ranked lines wait for the separator
+        self.flush()
 
     def output(self, fmt, deltas, values):
+        if self.top is not None:
+            self.rank(fmt, deltas, values)
+        else:
+            self.output_line(fmt, deltas, values)
+
+    def output_line(self, fmt, deltas, values):
         if self.separators_pending == 0:
             self.multiline = True
 
@@ -285,44 +1087,1291 @@ class Printer(object):
         self.print_chunks(chunks)
 
 
-def fd_feed(fd, sep_interval):
+class ScreenPrinter(Printer):
+    # Redraws a fixed screen instead of scrolling: every (label, format) pair
+    # gets its own row and only the cells that changed are rewritten.
+    def __init__(self, fp, max_fps=10, height=None, parser=None):
+        super(ScreenPrinter, self).__init__(fp, False, False, False, False)
+        self.min_delay = 1.0 / max_fps
+        self.height = height
+        self.parser = parser
+        self.rows = {}
+        # rows of formats the parser dropped, lowest first; row 1 is the clock
+        self.free_rows = []
+        self.next_row = 2
+        self.cleared = []
+        self.screen = {}
+        self.frame = {}
+        self.drawn_at = None
+
+    def clock(self):  # pragma: no cover
+        return monotonic()
+
+    def cells(self, fmt, values):
+        values = iter(values)
+        cells = []
+        if self.label is not None:
+            label = u'{0}: '.format(self.label)
+            cells.append((len(label), label))
+        for chunk in fmt.chunks:
+            if isinstance(chunk, NumberChunk):
+                value = next(values)
+                text = chunk.render(value, False)
+                cells.append((len(text), chunk.render(value) if fmt.colors else text))
+            else:
+                text = chunk.static_str.rstrip(u'\n')
+                cells.append((len(text), text))
+        return cells
+
+    def output(self, fmt, deltas, values):
+        key = (self.label, fmt.key)
+        row = self.rows.get(key)
+        if row is None:
+            if self.free_rows:
+                row = heapq.heappop(self.free_rows)
+            else:
+                row = self.next_row
+                self.next_row += 1
+            self.rows[key] = row
+        if self.height is not None and row > self.height:
+            return
+        if deltas is None:
+            fmt = fmt.plain()
+        else:
+            values = deltas
+        self.frame[row] = self.cells(fmt, values)
+
+    def free(self):
+        # rows of formats the parser no longer has are cleared for reuse
+        live = live_keys(self.parser)
+        for key in [key for key in self.rows if key not in live]:
+            row = self.rows.pop(key)
+            heapq.heappush(self.free_rows, row)
+            self.frame.pop(row, None)
+            if self.screen.pop(row, None) is not None:
+                self.cleared.append(row)
+
+    def draw(self):
+        out = []
+        if self.drawn_at is None:
+            out.append(u'\x1b[H\x1b[2J')
+        self.drawn_at = self.clock()
+        for row in self.cleared:
+            if row not in self.frame:
+                out.append(u'\x1b[{0};1H\x1b[K'.format(row))
+        self.cleared = []
+        out.append(u'\x1b[1;1H{0}\x1b[K'.format(self.now()))
+        cursor = None
+        for row in sorted(self.frame):
+            cells = self.frame[row]
+            old = self.screen.get(row)
+            # once a cell changes width, everything right of it moves
+            shifted = old is None or len(old) != len(cells)
+            col = 1
+            for i, cell in enumerate(cells):
+                if shifted or cell != old[i]:
+                    if not shifted and cell[0] != old[i][0]:
+                        shifted = True
+                    if cursor != (row, col):
+                        out.append(u'\x1b[{0};{1}H'.format(row, col))
+                    out.append(cell[1])
+                    cursor = (row, col + cell[0])
+                col += cell[0]
+            if shifted:
+                out.append(u'\x1b[K')
+            self.screen[row] = cells
+        self.frame = {}
+        out.append(u'\x1b[{0};1H'.format(max(self.screen) + 1 if self.screen else 2))
+        self.fp.write(u''.join(out))
+        self.fp.flush()
+
+    def separator(self):
+        # every row belongs to a format, so more rows than formats means
+        # some were dropped
+        if self.parser is not None and len(self.rows) > len(self.parser.formats):
+            self.free()
+        # a frame that comes too soon after the last one is merged into the next
+        if self.frame and (self.drawn_at is None or self.clock() - self.drawn_at >= self.min_delay):
+            self.draw()
+
+    # input can block in the middle of a tick too, so this is rate limited
+    idle = separator
+
+    def finish(self):
+        if self.frame:
+            self.draw()
+
+
+class RecordPrinter(Printer):
+    # One JSON object (or one CSV row per number) for every line, with
+    # no alignment or colors; rates are over each line's own interval.
+    CSV_HEADER = u'time,source,key,index,value,delta,rate\r\n'
+
+    def __init__(self, fp, parser, style=u'json', batch=True, max_delay=0.1):
+        super(RecordPrinter, self).__init__(fp, False, False, False, False, batch, max_delay)
+        import json
+        self.dumps = json.dumps
+        self.parser = parser
+        self.style = style
+        self.time = None
+        self.prefixes = {}
+        if style == u'csv':
+            self.print_chunks([self.CSV_HEADER])
+
+    def wallclock(self):
+        if self.wall_time is not None:
+            return self.wall_time
+        # when the tick's sample was taken, not when its first line got
+        # here, which may be much later after a slow parse
+        return time.time() - (monotonic() - self.parser.now())
+
+    def separator(self):
+        if self.buffer:
+            self.flush()
+        self.time = None
+
+    def prefix(self, fmt):
+        # the source and key only need to be encoded once per format
+        key = (self.label, fmt.key)
+        prefix = self.prefixes.get(key)
+        if prefix is None:
+            if self.style == u'csv':
+                prefix = u'{0},{1},'.format(csv_quote(self.label or u''), csv_quote(fmt.key))
+            else:
+                prefix = u'"source": {0}, "key": {1}, '.format(self.dumps(self.label), self.dumps(fmt.key))
+            prune_cache(self.prefixes, self.parser)
+            prefix = self.prefixes[key] = prefix
+        return prefix
+
+    def output(self, fmt, deltas, values):
+        if self.time is None:
+            # all lines of a tick get the same time
+            self.time = repr(round(self.wallclock(), 3))
+        rates = None
+        if deltas is not None:
+            rates = self.parser.rates_of(fmt, deltas)
+        prefix = self.prefix(fmt)
+        if self.style == u'csv':
+            chunks = [u'{0},{1}{2},{3},{4},{5}\r\n'.format(
+                self.time, prefix, i, value,
+                u'' if deltas is None else deltas[i], u'' if rates is None else rates[i])
+                for i, value in enumerate(values)]
+        else:
+            chunks = [u'{{"time": {0}, {1}"values": {2}, "deltas": {3}, "rates": {4}}}\n'.format(
+                self.time, prefix, self.dumps(values), self.dumps(deltas), self.dumps(rates))]
+        self.print_chunks(chunks)
+
+    def finish(self):
+        self.flush()
+
+
+def csv_quote(text):
+    return u'"{0}"'.format(text.replace(u'"', u'""'))
+
+
+def live_keys(parser):
+    # (source, format key) of every format the parser still has
+    return set((key[0] if isinstance(key, tuple) else None, fmt.key) for key, fmt in parser.formats.items())
+
+
+def prune_cache(cache, parser):
+    # caches keyed by (source, format key) forget the formats the parser
+    # has evicted or dropped, once those make up half of them
+    if len(cache) < 2 * len(parser.formats):
+        return
+    live = live_keys(parser)
+    for key in [key for key in cache if key not in live]:
+        del cache[key]
+
+
+class MetricsPrinter(Printer):
+    # Keeps an OpenMetrics page with the values, deltas and rates of every
+    # format instead of writing anything; the page is rendered once when a
+    # tick's output is complete and handed to scrapers as is.
+    CONTENT_TYPE = u'application/openmetrics-text; version=1.0.0; charset=utf-8'
+    FAMILIES = (
+        (u'delta_value', u'Last value of the number'),
+        (u'delta_delta', u'Change of the number over the last interval'),
+        (u'delta_rate', u'Change of the number per second over the last interval'),
+    )
+
+    def __init__(self, fp, parser):
+        super(MetricsPrinter, self).__init__(fp, False, False, False, False)
+        self.parser = parser
+        self.labels = {}
+        # series of the last complete tick stay until the next one completes
+        self.previous = OrderedDict()
+        self.current = OrderedDict()
+        self.dirty = False
+        self.page = self.render()
+
+    def metric_labels(self, fmt):
+        # label sets only need to be escaped once per format and number
+        key = (self.label, fmt.key)
+        labels = self.labels.get(key)
+        if labels is None:
+            prune_cache(self.labels, self.parser)
+            prefix = u'source="{0}",key="{1}",index='.format(metric_escape(self.label or u''), metric_escape(fmt.key))
+            labels = self.labels[key] = [u'{{{0}"{1}"}} '.format(prefix, i) for i in range(len(fmt.numbers))]
+        return labels
+
+    def output(self, fmt, deltas, values):
+        rates = None
+        if deltas is not None:
+            rates = self.parser.rates_of(fmt, deltas)
+        # a format evicted and parsed again is still the same series
+        self.current[(self.label, fmt.key)] = (self.metric_labels(fmt), values, deltas, rates)
+        self.dirty = True
+
+    def separator(self):
+        if self.dirty:
+            self.finish()
+        self.previous = self.current
+        self.current = OrderedDict()
+
+    def idle(self):
+        # the feed waits for the next tick (or more input) now, so scrapers
+        # get what this one has so far instead of waiting a whole interval
+        self.finish()
+
+    def render(self):
+        series = OrderedDict(self.previous)
+        series.update(self.current)
+        lines = []
+        for column, (name, text) in enumerate(self.FAMILIES, 1):
+            lines.append(u'# TYPE {0} gauge\n# HELP {0} {1}\n'.format(name, text))
+            for entry in series.values():
+                numbers = entry[column]
+                if numbers is not None:
+                    lines.extend(u'{0}{1}{2}\n'.format(name, labels, metric_number(number))
+                                 for labels, number in zip(entry[0], numbers))
+        lines.append(u'# EOF\n')
+        return u''.join(lines).encode(u'utf-8')
+
+    def finish(self):
+        if self.dirty:
+            # a single assignment, so that scrapers see either page whole
+            self.page = self.render()
+            self.dirty = False
+
+
+def metric_escape(text):
+    return text.replace(u'\\', u'\\\\').replace(u'"', u'\\"').replace(u'\n', u'\\n')
+
+
+def metric_number(number):
+    if isinstance(number, float):
+        if number != number:
+            return u'NaN'
+        if number in (float(u'inf'), float(u'-inf')):
+            return u'+Inf' if number > 0 else u'-Inf'
+        return repr(float(number))
+    return u'{0:d}'.format(int(number))
+
+
+def parse_address(text):
+    # HOST:PORT, :PORT or the path of a Unix socket
+    if u'/' in text:
+        return text
+    host, sep, port = text.rpartition(u':')
+    if not sep or not port.isdigit():
+        raise ValueError(u'Expected HOST:PORT or a socket path: {0}'.format(text))
+    return host.strip(u'[]') or u'127.0.0.1', int(port)
+
+
+def serve_metrics(address, printer):
+    # scrapers are answered from a background thread with whatever page the
+    # printer has last rendered, so their number does not matter to sampling
+    import socket
+    import threading
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+    except ImportError:  # pragma no cover, python 2
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split(u'?')[0] not in (u'/', u'/metrics'):
+                self.send_error(404)
+                return
+            page = printer.page
+            self.send_response(200)
+            self.send_header(u'Content-Type', printer.CONTENT_TYPE)
+            self.send_header(u'Content-Length', str(len(page)))
+            self.end_headers()
+            self.wfile.write(page)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+        def server_bind(self):
+            if self.address_family == socket.AF_UNIX:
+                # HTTPServer wants a host and port to remember; a stale
+                # socket is replaced, a live one or any other file is left alone
+                try:
+                    mode = os.stat(self.server_address).st_mode
+                except OSError:
+                    mode = None
+                if mode is not None:
+                    if not stat.S_ISSOCK(mode):
+                        raise IOError(errno.EEXIST, u'Not a socket', self.server_address)
+                    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    try:
+                        probe.connect(self.server_address)
+                    except socket.error:
+                        os.unlink(self.server_address)
+                    else:
+                        raise IOError(errno.EADDRINUSE, u'Socket in use', self.server_address)
+                    finally:
+                        probe.close()
+                self.socket.bind(self.server_address)
+                self.server_name, self.server_port = self.server_address, 0
+            else:
+                HTTPServer.server_bind(self)
+
+    if isinstance(address, tuple):
+        Server.address_family = socket.AF_INET6 if u':' in address[0] else socket.AF_INET
+    else:
+        Server.address_family = socket.AF_UNIX
+    server = Server(address, Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def fd_lines(fileno, encoding, gap, markers=False, delimiter=None, blocks=False, chunk_size=65536):
+    decoder = codecs.getincrementaldecoder(encoding)(u'replace')
+    pending = u''
+    while True:
+        if not select.select([fileno], [], [], 0)[0]:
+            # the next read is going to block, let the output catch up
+            if markers:
+                yield idle
+            if delimiter is None and not select.select([fileno], [], [], gap)[0]:
+                # no data for a while, that's the end of a chunk
+                yield separator
+        data = os.read(fileno, chunk_size)
+        if not data:
+            if pending:
+                yield pending
+            break
+        if markers:
+            yield Timestamp(monotonic())
+        text = pending + decoder.decode(data)
+        if blocks and delimiter is None:
+            end = text.rfind(u'\n') + 1
+            pending = text[end:]
+            if end:
+                yield Block(text[:end])
+            continue
+        lines = text.split(u'\n')
+        pending = lines.pop()
+        for line in lines:
+            if delimiter is not None and delimiter.search(line):
+                yield separator
+            yield line + u'\n'
+
+
+def fd_feed(fd, sep_interval, markers=False, delimiter=None, blocks=False):
+    try:
+        fileno = fd.fileno()
+    except (AttributeError, UnsupportedOperation):
+        pass
+    else:
+        fd_encoding = getattr(fd, u'encoding', None) or locale.getdefaultlocale()[1]
+        for line in fd_lines(fileno, fd_encoding, sep_interval, markers, delimiter, blocks):
+            yield line
+        return
+
     while True:
-        ts = time.time()
+        ts = monotonic()
         line = fd.readline()
         if sys.version_info[0] == 2:
             line = line.decode(encoding)
         if not line:
             break
-        delta = time.time() - ts
-        if delta > sep_interval:
+        now = monotonic()
+        if delimiter is not None:
+            if delimiter.search(line):
+                yield separator
+        elif now - ts > sep_interval:
             yield separator
+        if markers:
+            yield Timestamp(now)
         yield line
 
 
-def command_feed(cmd, interval, count=None):
-    _, encoding = locale.getdefaultlocale()
+class Scheduler(object):
+    OVERRUN_POLICIES = (u'skip', u'catch-up', u'back-to-back')
+
+    def __init__(self, interval, overrun=u'skip'):
+        if overrun not in self.OVERRUN_POLICIES:
+            raise ValueError(u'Unknown overrun policy {0!r}'.format(overrun))
+        self.interval = interval
+        self.overrun = overrun
+        self.deadline = None
+        self.ticks = 0
+        self.skipped = 0
+        self.jitter_total = 0.0
+        self.jitter_max = 0.0
+
+    def clock(self):  # pragma: no cover
+        return monotonic()
+
+    def sleep(self, seconds):  # pragma: no cover
+        time.sleep(seconds)
+
+    def next_deadline(self, now):
+        if self.deadline is None or self.interval <= 0:
+            # no interval means no waiting at all
+            return now
+
+        deadline = self.deadline + self.interval
+        if now <= deadline or self.overrun == u'catch-up':
+            return deadline
+        if self.overrun == u'back-to-back':
+            return now
+
+        missed = int((now - deadline) // self.interval) + 1
+        self.skipped += missed
+        return deadline + missed * self.interval
+
+    def schedule(self):
+        # deadlines are fixed multiples of interval apart, no matter
+        # how long the work between two ticks took
+        self.deadline = self.next_deadline(self.clock())
+        return self.deadline
+
+    def fire(self):
+        jitter = max(self.clock() - self.deadline, 0)
+        self.ticks += 1
+        self.jitter_total += jitter
+        self.jitter_max = max(self.jitter_max, jitter)
+
+    def wait(self):
+        delay = self.schedule() - self.clock()
+        if delay > 0:
+            self.sleep(delay)
+        self.fire()
+
+    def report(self):
+        return u'{0} ticks, {1} skipped, jitter avg {2:.3f}ms max {3:.3f}ms'.format(
+            self.ticks, self.skipped,
+            1000 * self.jitter_total / max(self.ticks, 1), 1000 * self.jitter_max)
+
+
+def shell_command(cmd):
     if len(cmd) == 1:
         shell = os.getenv(u'SHELL', u'/bin/sh')
-        cmd = (shell, u'-c') + cmd
+        return (shell, u'-c') + tuple(cmd)
+    return cmd
+
+
+def command_feed(cmd, interval, count=None, markers=False, scheduler=None, blocks=False):
+    _, encoding = locale.getdefaultlocale()
+    if scheduler is None:
+        scheduler = Scheduler(interval)
+    cmd = shell_command(cmd)
     while count is None or count > 0:
         if count is not None:
             count -= 1
+        scheduler.wait()
         output = subprocess.check_output(cmd)
-        first = True
-        for line in output.splitlines():
-            if first:
-                first = False
+        ts = Timestamp(monotonic())
+        if blocks:
+            lines = text_items(output.decode(encoding), blocks)
+        else:
+            lines = [line.decode(encoding) + u'\n' for line in output.splitlines()]
+        if lines:
+            yield separator
+            if markers:
+                yield ts
+        for line in lines:
+            yield line
+        if markers:
+            yield idle
+
+
+def stream_feed(cmd, gap, delimiter=None, markers=False, blocks=False):
+    _, encoding = locale.getdefaultlocale()
+    proc = subprocess.Popen(shell_command(cmd), stdout=subprocess.PIPE)
+    try:
+        for line in fd_lines(proc.stdout.fileno(), encoding, gap, markers, delimiter, blocks):
+            yield line
+    finally:
+        if proc.poll() is None:
+            proc.terminate()
+        proc.stdout.close()
+        proc.wait()
+
+
+# all of them read into buf from offset to its end, the way the file
+# position would be after reading offset bytes
+if hasattr(os, u'preadv'):
+    def pread_into(fd, buf, offset):
+        return os.preadv(fd, [memoryview(buf)[offset:]], offset)
+elif hasattr(os, u'pread'):  # pragma no cover, python < 3.7
+    def pread_into(fd, buf, offset):
+        data = os.pread(fd, len(buf) - offset, offset)
+        buf[offset:offset + len(data)] = data
+        return len(data)
+else:  # pragma no cover, python 2 (2.6 has no memoryview at all)
+    def pread_into(fd, buf, offset):
+        os.lseek(fd, offset, os.SEEK_SET)
+        data = os.read(fd, len(buf) - offset)
+        buf[offset:offset + len(data)] = data
+        return len(data)
+
+
+class FileReader(object):
+    # keep_open=False closes the file after every read and opens it again
+    # for the next, for when there are more files than file descriptors
+    def __init__(self, path, size=4096, keep_open=True):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        self.buf = bytearray(size)
+        self.keep_open = keep_open
+        if not keep_open:
+            self.close()
+
+    def read(self):
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDONLY)
+        try:
+            return self.read_all()
+        finally:
+            if not self.keep_open:
+                self.close()
+
+    def read_all(self):
+        # files in /proc and /sys report a size of zero, so keep reading
+        # (and growing the buffer) until we hit the end of file
+        length = 0
+        while True:
+            if length == len(self.buf):
+                self.buf.extend(bytearray(len(self.buf)))
+            n = pread_into(self.fd, self.buf, length)
+            if not n:
+                # a copy, so that the buffer can be reused (and grown) next time
+                return bytes(self.buf[:length])
+            length += n
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def open_readers(paths):
+    readers = []
+    try:
+        for path in paths:
+            readers.append(FileReader(path))
+    except EnvironmentError:
+        for reader in readers:
+            reader.close()
+        raise
+    return readers
+
+
+def file_feed(paths, interval, count=None, markers=False, scheduler=None, blocks=False):
+    # the files are opened right away, so that a wrong path is reported
+    # before the feed starts
+    return file_lines(open_readers(paths), interval, count, markers, scheduler, blocks)
+
+
+def file_lines(readers, interval, count=None, markers=False, scheduler=None, blocks=False):
+    _, encoding = locale.getdefaultlocale()
+    if scheduler is None:
+        scheduler = Scheduler(interval)
+    try:
+        while count is None or count > 0:
+            if count is not None:
+                count -= 1
+            scheduler.wait()
+            yield separator
+            for reader in readers:
+                data = reader.read()
+                if markers:
+                    yield Timestamp(monotonic())
+                if len(readers) > 1:
+                    yield Source(reader.path)
+                for line in text_items(codecs.decode(data, encoding), blocks):
+                    yield line
+            if markers:
+                yield idle
+    finally:
+        for reader in readers:
+            reader.close()
+
+
+class CommandSource(object):
+    def __init__(self, cmd):
+        self.name = u' '.join(cmd)
+        self.cmd = shell_command(cmd)
+        self.done = None
+        self.timestamp = None
+        self.transport = None
+
+    def start(self, loop, asyncio):
+        source = self
+        output = []
+
+        class Protocol(asyncio.SubprocessProtocol):
+            def pipe_data_received(self, fd, data):
+                output.append(data)
+
+            def connection_lost(self, exc):
+                # called once the process exited and its stdout got closed
+                if not source.done.done():
+                    source.done.set_result(b''.join(output))
+
+        def started(task):
+            if task.exception() is not None:
+                self.done.set_exception(task.exception())
+            else:
+                self.transport = task.result()[0]
+
+        self.done = loop.create_future()
+        self.timestamp = Timestamp(monotonic())
+        loop.create_task(loop.subprocess_exec(Protocol, *self.cmd)).add_done_callback(started)
+
+    def finish(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        done, self.done = self.done, None
+        return done.result()
+
+    def kill(self):
+        if self.transport is not None:
+            try:
+                self.transport.kill()
+            except ProcessLookupError:  # pragma: no cover
+                pass
+            self.transport.close()
+
+
+def swap_event_loop(asyncio, loop):
+    try:
+        previous = asyncio.get_event_loop()
+    except RuntimeError:  # pragma: no cover, not the main thread
+        previous = None
+    asyncio.set_event_loop(loop)
+    return previous
+
+
+def multi_feed(commands, paths, interval, count=None, markers=False, scheduler=None, blocks=False):
+    # like file_feed(), the files are opened right away
+    return multi_lines(commands, open_readers(paths), interval, count, markers, scheduler, blocks)
+
+
+def multi_lines(commands, readers, interval, count=None, markers=False, scheduler=None, blocks=False):
+    # only needed here, so `delta` alone does not pay for importing it
+    import asyncio
+
+    _, encoding = locale.getdefaultlocale()
+    if scheduler is None:
+        scheduler = Scheduler(interval)
+    loop = asyncio.new_event_loop()
+    sources = [CommandSource(cmd) for cmd in commands]
+
+    def sample_lines(name, timestamp, data):
+        if markers:
+            yield timestamp
+        yield Source(name)
+        for line in text_items(codecs.decode(data, encoding), blocks):
+            yield line
+
+    def collect(deadline):
+        # pass on command output as it arrives, until the next tick is due
+        while True:
+            running = [source.done for source in sources if source.done is not None]
+            timeout = None if deadline is None else deadline - scheduler.clock()
+            if not running or (timeout is not None and timeout <= 0):
+                break
+            if markers:
+                yield idle
+            done, _ = loop.run_until_complete(asyncio.wait(
+                running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED))
+            for source in sources:
+                if source.done in done:
+                    timestamp = source.timestamp
+                    for line in sample_lines(source.name, timestamp, source.finish()):
+                        yield line
+
+        if deadline is not None and deadline > scheduler.clock():
+            if markers:
+                yield idle
+            scheduler.sleep(deadline - scheduler.clock())
+
+    # before Python 3.8 the child watcher only sees processes started from
+    # the loop it is attached to, which is the current one
+    swap = sys.version_info < (3, 8)
+    previous = swap_event_loop(asyncio, loop) if swap else None
+    try:
+        while count is None or count > 0:
+            if count is not None:
+                count -= 1
+            for line in collect(scheduler.schedule()):
+                yield line
+            scheduler.fire()
+
+            yield separator
+            for source in sources:
+                # a source still busy with the last tick just misses this one
+                if source.done is None:
+                    source.start(loop, asyncio)
+            for reader in readers:
+                timestamp = Timestamp(monotonic())
+                for line in sample_lines(reader.path, timestamp, reader.read()):
+                    yield line
+
+        for line in collect(None):
+            yield line
+    finally:
+        for source in sources:
+            source.kill()
+        for reader in readers:
+            reader.close()
+        if swap:
+            swap_event_loop(asyncio, previous)
+        loop.close()
+
+
+def read_text(reader, encoding):
+    try:
+        data = reader.read()
+    except EnvironmentError:
+        # e.g. /proc/<pid>/io after the process exited
+        return None, None
+    return Timestamp(monotonic()), codecs.decode(data, encoding)
+
+
+def open_file_limit():
+    try:
+        import resource
+    except ImportError:  # pragma: no cover, not on unix
+        return 256
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return 4096
+    # leave room for everything else delta has open, like command pipes
+    return max(soft // 2, 8)
+
+
+def glob_feed(patterns, interval, count=None, markers=False, scheduler=None, blocks=False, rescan=10, threads=8,
+              max_open=None, log=None):
+    import glob
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+    except ImportError:  # pragma: no cover, python 2 without the futures backport
+        ThreadPoolExecutor = None
+
+    _, encoding = locale.getdefaultlocale()
+    if scheduler is None:
+        scheduler = Scheduler(interval)
+    if max_open is None:
+        max_open = open_file_limit()
+    if log is None:
+        log = sys.stderr
+    pool = ThreadPoolExecutor(threads) if ThreadPoolExecutor is not None else None
+    readers = OrderedDict()
+    # files that could not be opened, reported once each
+    failed = set()
+
+    def forget(path):
+        readers.pop(path).close()
+        return Gone(path)
+
+    def balance():
+        # the first max_open files stay open, the rest are opened for every
+        # read; with all files read every tick, closing the least recently
+        # used one would only ever close the file that is read next
+        kept = sum(1 for reader in readers.values() if reader.keep_open)
+        for reader in readers.values():
+            if kept >= max_open:
+                break
+            if not reader.keep_open:
+                reader.keep_open = True
+                kept += 1
+
+    def scan():
+        paths = set()
+        for pattern in patterns:
+            paths.update(glob.glob(pattern))
+        for path in [p for p in readers if p not in paths]:
+            yield forget(path)
+        failed.intersection_update(paths)
+        errors = []
+        kept = sum(1 for reader in readers.values() if reader.keep_open)
+        for path in sorted(paths.difference(readers)):
+            try:
+                readers[path] = FileReader(path, keep_open=kept < max_open)
+            except EnvironmentError as exc:
+                # unreadable files (e.g. other users' processes) are tried
+                # again on the next rescan
+                if path not in failed:
+                    failed.add(path)
+                    errors.append(exc)
+                continue
+            kept += readers[path].keep_open
+        if errors:
+            log.write(u'delta: cannot open {0} files, e.g. {1}: {2}\n'.format(
+                len(errors), errors[0].filename, errors[0].strerror))
+
+    def read_all(readers):
+        if pool is None:
+            return [read_text(reader, encoding) for reader in readers]
+        return pool.map(read_text, readers, [encoding] * len(readers))
+
+    try:
+        tick = 0
+        while count is None or count > 0:
+            if count is not None:
+                count -= 1
+            scheduler.wait()
+            if tick % rescan == 0:
+                for item in scan():
+                    yield item
+                balance()
+            tick += 1
+
+            yield separator
+            current = list(readers.values())
+            for reader, (timestamp, text) in zip(current, read_all(current)):
+                if text is None:
+                    yield forget(reader.path)
+                    balance()
+                    continue
+                if markers:
+                    yield timestamp
+                yield Source(reader.path)
+                for line in text_items(text, blocks):
+                    yield line
+            if markers:
+                yield idle
+    finally:
+        for reader in readers.values():
+            reader.close()
+        if pool is not None:
+            pool.shutdown()
+
+
+class RecordingError(ValueError):
+    pass
+
+
+# A recording is a sequence of sessions, each starting with SESSION_MAGIC
+# (so that several runs can append to one file). Every item starts with
+# a tag byte; a line is stored as the id of its skeleton (recorded once per
+# session) followed by every number as its leading spaces and its value,
+# both as varints. Numbers that would not survive the trip through int()
+# (leading zeros, fractions) are stored as text instead. A block is its
+# number of lines followed by those lines, so that blocks cut anywhere or
+# with rows coming and going still share the skeletons of their lines.
+TAG_SESSION = 0x7f
+SESSION_MAGIC = b'\x7fDLT1\n'
+TAG_SEPARATOR, TAG_TIMESTAMP, TAG_IDLE, TAG_NEW_SOURCE, TAG_SOURCE, TAG_GONE = range(1, 7)
+TAG_NEW_SKELETON, TAG_LINE, TAG_BLOCK, TAG_RAW_LINE = range(16, 20)
+# a native string, struct takes no unicode formats before Python 2.7.7
+DOUBLE = struct.Struct('<d')
+
+
+def put_varint(buf, n):
+    while n > 0x7f:
+        buf.append(n & 0x7f | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def put_bytes(buf, text):
+    data = text.encode(u'utf-8')
+    put_varint(buf, len(data))
+    buf.extend(data)
+
+
+class Recorder(object):
+    def __init__(self, fp):
+        self.fp = fp
+        self.skeletons = {}
+        self.sources = {}
+        # a separator is written with the next item, which may be the
+        # WallTime of a replayed one to keep instead of the current time
+        self.pending = None
+        fp.write(SESSION_MAGIC)
+
+    def line(self, buf, line):
+        if u'\0' in line:
+            buf.append(TAG_RAW_LINE)
+            put_bytes(buf, line)
+            return
+        elts = Parser.number_re.split(line)
+        skeleton = u'\0'.join(elts[::3])
+        skeleton_id = self.skeletons.get(skeleton)
+        if skeleton_id is None:
+            skeleton_id = self.skeletons[skeleton] = len(self.skeletons)
+            buf.append(TAG_NEW_SKELETON)
+            put_bytes(buf, skeleton)
+        buf.append(TAG_LINE)
+        put_varint(buf, skeleton_id)
+        for spaces, number in zip(elts[1::3], elts[2::3]):
+            put_varint(buf, len(spaces))
+            if number.isdigit() and (number == u'0' or number[0] != u'0'):
+                put_varint(buf, int(number) << 1)
+            else:
+                put_varint(buf, len(number) << 1 | 1)
+                buf.extend(number.encode(u'ascii'))
+
+    def block(self, buf, text):
+        lines = text.split(u'\n')
+        last = lines.pop()
+        lines = [line + u'\n' for line in lines]
+        if last:
+            lines.append(last)
+        buf.append(TAG_BLOCK)
+        put_varint(buf, len(lines))
+        for line in lines:
+            self.line(buf, line)
+
+    def source(self, buf, name, tag):
+        source_id = self.sources.get(name)
+        if source_id is None:
+            source_id = self.sources[name] = len(self.sources)
+            buf.append(TAG_NEW_SOURCE)
+            put_bytes(buf, name)
+        buf.append(tag)
+        put_varint(buf, source_id)
+
+    def record(self, item):
+        buf = bytearray()
+        if self.pending is not None:
+            buf.append(TAG_SEPARATOR)
+            buf.extend(DOUBLE.pack(item if isinstance(item, WallTime) else self.pending))
+            self.pending = None
+        if item is separator:
+            self.pending = time.time()
+        elif isinstance(item, WallTime):
+            pass
+        elif item is idle:
+            buf.append(TAG_IDLE)
+        elif isinstance(item, Timestamp):
+            buf.append(TAG_TIMESTAMP)
+            buf.extend(DOUBLE.pack(item))
+        elif isinstance(item, Source):
+            self.source(buf, item.name, TAG_SOURCE)
+        elif isinstance(item, Gone):
+            self.source(buf, item.name, TAG_GONE)
+        elif isinstance(item, Block):
+            self.block(buf, item.text)
+        else:
+            self.line(buf, item)
+        self.fp.write(buf)
+        if item is idle:
+            self.fp.flush()
+
+    def close(self):
+        if self.pending is not None:
+            self.fp.write(bytearray([TAG_SEPARATOR]) + DOUBLE.pack(self.pending))
+            self.pending = None
+        self.fp.flush()
+
+
+def record_feed(feed, fp):
+    recorder = Recorder(fp)
+    try:
+        for item in feed:
+            recorder.record(item)
+            yield item
+    finally:
+        recorder.close()
+
+
+def map_file(fp):
+    try:
+        import mmap
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ImportError, ValueError, EnvironmentError, UnsupportedOperation):
+        # empty files, pipes and the like
+        data = fp.read()
+    if bytes is str:  # pragma: no cover, python 2 indexes bytes as strings
+        data = bytearray(data)
+    return data
+
+
+def replay_feed(fp, speed=0, markers=False, blocks=False):
+    data = map_file(fp)
+    end = len(data)
+    pos = [0]
+
+    def byte():
+        if pos[0] >= end:
+            raise RecordingError(u'recording is truncated')
+        pos[0] += 1
+        return data[pos[0] - 1]
+
+    def take(length):
+        start = pos[0]
+        if start + length > end:
+            raise RecordingError(u'recording is truncated')
+        pos[0] += length
+        return data[start:pos[0]]
+
+    def varint():
+        n = shift = 0
+        while True:
+            b = byte()
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    def text():
+        return take(varint()).decode(u'utf-8')
+
+    def double():
+        return DOUBLE.unpack(bytes(take(8)))[0]
+
+    def numbers(skeleton):
+        parts = [skeleton[0]]
+        for piece in skeleton[1:]:
+            parts.append(u' ' * varint())
+            n = varint()
+            if n & 1:
+                parts.append(take(n >> 1).decode(u'ascii'))
+            else:
+                parts.append(str(n >> 1))
+            parts.append(piece)
+        return u''.join(parts)
+
+    def line(tag):
+        if tag == TAG_NEW_SKELETON:
+            skeletons.append(text().split(u'\0'))
+            return None
+        if tag == TAG_LINE:
+            return numbers(skeletons[varint()])
+        if tag == TAG_RAW_LINE:
+            return text()
+        raise RecordingError(u'unknown record type {0} at offset {1}'.format(tag, pos[0] - 1))
+
+    def block():
+        count = varint()
+        lines = []
+        while len(lines) < count:
+            item = line(byte())
+            if item is not None:
+                lines.append(item)
+        return u''.join(lines)
+
+    skeletons = sources = None
+    last = None
+    try:
+        while pos[0] < end:
+            tag = data[pos[0]]
+            if tag == TAG_SESSION and data[pos[0]:pos[0] + len(SESSION_MAGIC)] == SESSION_MAGIC:
+                pos[0] += len(SESSION_MAGIC)
+                skeletons = []
+                sources = []
+                last = None
+                continue
+            if skeletons is None:
+                raise RecordingError(u'not a delta recording')
+            pos[0] += 1
+            if tag == TAG_SEPARATOR:
+                wall_time = double()
                 yield separator
-            yield line.decode(encoding) + u'\n'
-        time.sleep(interval)
+                if markers:
+                    yield WallTime(wall_time)
+            elif tag == TAG_TIMESTAMP:
+                timestamp = double()
+                if speed and last is not None and timestamp > last:
+                    time.sleep((timestamp - last) / speed)
+                last = timestamp
+                if markers:
+                    yield Timestamp(timestamp)
+            elif tag == TAG_IDLE:
+                if markers:
+                    yield idle
+            elif tag == TAG_NEW_SOURCE:
+                sources.append(text())
+            elif tag == TAG_SOURCE:
+                name = sources[varint()]
+                if markers:
+                    yield Source(name)
+            elif tag == TAG_GONE:
+                name = sources[varint()]
+                if markers:
+                    yield Gone(name)
+            elif tag == TAG_BLOCK:
+                for item in text_items(block(), blocks):
+                    yield item
+            else:
+                item = line(tag)
+                if item is not None:
+                    yield item
+    except IndexError:
+        raise RecordingError(u'unknown skeleton or source at offset {0}'.format(pos[0]))
+
+
+class TimedWriter(object):
+    def __init__(self, fp, profiler):
+        self.fp = fp
+        self.profiler = profiler
+
+    def write(self, data):
+        start = self.profiler.clock()
+        self.fp.write(data)
+        self.profiler.write += self.profiler.clock() - start
+
+    def flush(self):
+        start = self.profiler.clock()
+        self.fp.flush()
+        self.profiler.write += self.profiler.clock() - start
+
+
+class Profiler(object):
+    # CPU time spent by delta itself in each stage; waiting for input or
+    # for the next interval does not count
+    clock = staticmethod(getattr(time, u'process_time', None) or time.clock)
+
+    def __init__(self, parser, out, interval=None):
+        self.parser = parser
+        self.out = out
+        self.interval = interval
+        # parse includes new_parse, the time spent on lines without a format
+        self.feed = self.parse = self.new_parse = self.format = self.write = 0.0
+        self.hits = self.new = self.ticks = 0
+        self.depth = 0
+        self.printing = False
+        self.reported = monotonic()
+
+    def instrument(self, feed, parser, printer):
+        process, process_text, parse = parser.process, parser.process_text, parser.parse
+
+        def timed(func, count):
+            def wrapper(*args):
+                if self.depth:
+                    # process_text() falling back to process()
+                    return func(*args)
+                self.depth += 1
+                start = self.clock()
+                try:
+                    result = func(*args)
+                finally:
+                    self.parse += self.clock() - start
+                    self.depth -= 1
+                count(result)
+                return result
+            return wrapper
+
+        def timed_parse(*args):
+            start = self.clock()
+            try:
+                return parse(*args)
+            finally:
+                self.new_parse += self.clock() - start
+
+        def timed_printer(func):
+            # with --top (or on screen) lines are formatted when the tick
+            # ends, not when they come in
+            def wrapper(*args):
+                if self.printing:
+                    # e.g. MetricsPrinter.idle() rendering through finish()
+                    return func(*args)
+                self.printing = True
+                written = self.write
+                start = self.clock()
+                try:
+                    func(*args)
+                finally:
+                    self.format += self.clock() - start - (self.write - written)
+                    self.printing = False
+            return wrapper
+
+        parser.process = timed(process, lambda result: self.count([result]))
+        parser.process_text = timed(process_text, self.count)
+        parser.parse = timed_parse
+        for name in (u'output', u'separator', u'idle', u'finish'):
+            setattr(printer, name, timed_printer(getattr(printer, name)))
+        printer.fp = TimedWriter(printer.fp, self)
+        return self.timed_feed(feed)
+
+    def count(self, results):
+        for _, deltas, _ in results:
+            if deltas is None:
+                self.new += 1
+            else:
+                self.hits += 1
+
+    def timed_feed(self, feed):
+        feed = iter(feed)
+        while True:
+            start = self.clock()
+            try:
+                item = next(feed)
+            except StopIteration:
+                return
+            self.feed += self.clock() - start
+            if item is separator:
+                self.ticks += 1
+                if self.interval and monotonic() - self.reported >= self.interval:
+                    self.report()
+            yield item
+
+    @staticmethod
+    def usage():
+        try:
+            import resource
+        except ImportError:  # pragma: no cover, not on unix
+            return u''
+        # Linux reports kilobytes, macOS bytes
+        unit = 1 if sys.platform == u'darwin' else 1024
+        parts = []
+        for name, who in ((u'self', resource.RUSAGE_SELF), (u'children', resource.RUSAGE_CHILDREN)):
+            ru = resource.getrusage(who)
+            parts.append(u'{0}: cpu {1:.3f}s user, {2:.3f}s sys, max rss {3:.1f}MB'.format(
+                name, ru.ru_utime, ru.ru_stime, ru.ru_maxrss * unit / 2 ** 20))
+        return u'; ' + u'; '.join(parts)
+
+    def report(self):
+        self.reported = monotonic()
+        lines = self.hits + self.new
+        self.out.write(
+            u'delta: {0} ticks, {1} lines ({2:.1f}/tick); feed {3:.3f}s, parse {4:.3f}s ({5} hits {6:.3f}s, '
+            u'{7} new {8:.3f}s, {9:.1f}% hit rate), format {10:.3f}s, write {11:.3f}s; {12} formats cached{13}\n'.format(
+                self.ticks, lines, lines / max(self.ticks, 1), self.feed, self.parse, self.hits,
+                self.parse - self.new_parse, self.new, self.new_parse, 100 * self.hits / max(lines, 1), self.format,
+                self.write, len(self.parser.formats), self.usage()))
 
 
 def run(feed, parser, printer):
     for line in feed:
         if line is separator:
+            parser.tick()
             printer.separator()
+        elif line is idle:
+            printer.idle()
+        elif isinstance(line, Timestamp):
+            parser.timestamp = line
+        elif isinstance(line, WallTime):
+            printer.wall_time = line
+        elif isinstance(line, Source):
+            parser.source = printer.label = line.name
+        elif isinstance(line, Block):
+            for result in parser.process_text(line.text):
+                printer.output(*result)
+        elif isinstance(line, Gone):
+            parser.forget(line.name)
         else:
             printer.output(*parser.process(line))
+    printer.finish()
 
 
 def use_separators(cmd, separators, skip_zeros, timestamps):
@@ -345,40 +2394,276 @@ def use_colors(color, fd):
         except (AttributeError, UnsupportedOperation):
             return False
 
-def real_cli(stdin, stdout, cmd, timestamps, interval, flex, separators, color, orig, skip_zeros, absolute, count):
+def terminal_height(fp):
+    try:
+        return os.get_terminal_size(fp.fileno()).lines
+    except (AttributeError, ValueError, EnvironmentError, UnsupportedOperation):
+        return None
+
+
+def usage_error(message):
+    import click
+    return click.UsageError(message)
+
+
+def cli_error(message):
+    import click
+    return click.ClickException(message)
+
+
+def real_cli(stdin, stdout, cmd, timestamps, interval, flex, separators, color, orig, skip_zeros, absolute, count,
+             max_formats=None, batch=False, max_delay=0.1, overrun=u'skip', jitter=False, rate=False, files=(),
+             stream=False, delimiter=None, gap=None, commands=(), globs=(), rescan=10, threads=8, top=None,
+             screen=False, max_fps=10, output_format=u'text', record=None, replay=None, speed=0,
+             window=None, stats=(), stats_only=False, counters=None, extended=False, key_columns=(), key_regex=None,
+             profile=False, profile_interval=None, serve=None):
+    commands = [(c,) for c in commands]
     if cmd:
-        feed = command_feed(cmd, interval, count)
+        commands.append(cmd)
+    if globs and (commands or stream):
+        raise usage_error(u'Cannot combine --glob with commands')
+    if stream and (len(commands) != 1 or files):
+        raise usage_error(u'Streaming mode needs exactly one command')
+    if stream and not cmd:
+        raise usage_error(u'Streaming mode needs a command')
+    if screen and top:
+        raise usage_error(u'Cannot combine --screen with --top')
+    if replay is not None and (commands or files or globs or stream):
+        raise usage_error(u'Cannot combine --replay with commands or files')
+    if key_columns and key_regex is not None:
+        raise usage_error(u'Use either --key or --key-regex')
+    if (stats or stats_only) and not window:
+        raise usage_error(u'Statistics need a --window')
+    if window and not stats:
+        stats = (u'avg',)
+    if output_format != u'text' and (screen or top):
+        raise usage_error(u'--screen and --top only work with text output')
+    if serve is not None:
+        if output_format != u'text' or screen or top:
+            raise usage_error(u'Cannot combine --serve with --output, --screen or --top')
+        try:
+            serve = parse_address(serve)
+        except ValueError as exc:
+            raise usage_error(str(exc))
+    if len(commands) > 1 or (commands and files):
+        try:
+            import asyncio  # only to check that multi_feed() can work
+        except ImportError:  # pragma no cover, python 2
+            raise usage_error(u'Running several commands, or commands and files, needs Python 3.4 or later')
+    if gap is None:
+        gap = interval
+    if delimiter is not None:
+        delimiter = re.compile(delimiter)
+
+    scheduler = Scheduler(interval, overrun)
+    if replay is not None:
+        feed = replay_feed(replay, speed, markers=True, blocks=True)
+    elif globs:
+        feed = glob_feed(tuple(globs) + tuple(files), interval, count, markers=True, scheduler=scheduler, blocks=True,
+                         rescan=rescan, threads=threads)
+    elif files:
+        try:
+            if commands:
+                feed = multi_feed(commands, files, interval, count, markers=True, scheduler=scheduler, blocks=True)
+            else:
+                feed = file_feed(files, interval, count, markers=True, scheduler=scheduler, blocks=True)
+        except EnvironmentError as exc:
+            raise cli_error(u'Cannot read {0}: {1}'.format(exc.filename, exc.strerror))
+    elif len(commands) > 1:
+        feed = multi_feed(commands, files, interval, count, markers=True, scheduler=scheduler, blocks=True)
+    elif stream:
+        feed = stream_feed(cmd, gap, delimiter, markers=True, blocks=True)
+    elif commands:
+        feed = command_feed(commands[0], interval, count, markers=True, scheduler=scheduler, blocks=True)
     else:
-        feed = fd_feed(stdin, interval)
+        feed = fd_feed(stdin, gap, markers=True, delimiter=delimiter, blocks=True)
 
-    separators = use_separators(cmd, separators, skip_zeros, timestamps)
+    if record is not None:
+        feed = record_feed(feed, record)
+
+    polling = bool(commands or files or globs) and not stream
+    separators = use_separators(polling or stream or replay is not None, separators, skip_zeros, timestamps)
     color = use_colors(color, stdin)
 
-    parser = Parser(flex, absolute, color)
-    printer = Printer(stdout, timestamps, separators, orig, skip_zeros)
+    if output_format != u'text' or serve is not None:
+        # records and metrics carry both deltas and rates, and no colors
+        color = rate = False
+
+    parser = Parser(flex, absolute, color, max_formats, rate, window=window, counters=counters, extended=extended,
+                    key_columns=key_columns, key_regex=key_regex)
+    server = None
+    if serve is not None:
+        printer = MetricsPrinter(stdout, parser)
+        try:
+            server = serve_metrics(serve, printer)
+        except (IOError, OSError) as exc:
+            raise cli_error(u'Cannot serve on {0}: {1}'.format(serve, exc))
+    elif output_format != u'text':
+        printer = RecordPrinter(stdout, parser, output_format, batch, max_delay)
+    elif screen:
+        printer = ScreenPrinter(stdout, max_fps, terminal_height(stdout), parser)
+    else:
+        printer = Printer(stdout, timestamps, separators, orig, skip_zeros, batch, max_delay, top=top,
+                          windows=parser.windows, stats=stats, stats_only=stats_only, marks=bool(counters))
+
+    profiler = None
+    if profile or profile_interval:
+        profiler = Profiler(parser, sys.stderr, profile_interval)
+        feed = profiler.instrument(feed, parser, printer)
 
     try:
         run(feed, parser, printer)
 
     except (KeyboardInterrupt, IOError):  # pragma: no cover
         pass
+    except RecordingError as exc:
+        raise cli_error(u'{0}: {1}'.format(replay.name, exc))
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+            if not isinstance(serve, tuple):
+                try:
+                    os.unlink(serve)
+                except OSError:  # pragma: no cover
+                    pass
+
+    if parser.evicted:
+        sys.stderr.write(u'delta: evicted {0} formats (limit {1})\n'.format(parser.evicted, max_formats))
+    if jitter and polling:
+        sys.stderr.write(u'delta: {0}\n'.format(scheduler.report()))
+    if profiler is not None:
+        profiler.report()
+
+def make_cli():
+    # click takes a while to import and only the command line needs it
+    import click
+
+    @click.command()
+    @click.option(u'-t/-T', u'--timestamps/--no-timestamps', help=u'Show timestamps on all output lines')
+    @click.option(u'-i', u'--interval', metavar=u'SECONDS', type=click.FloatRange(0),
+        help=u'Interval between command runs', default=1)
+    @click.option(u'-f/-F', u'--flex/--no-flex', help=u'Tweak column widths for better output (default is on)', default=True)
+    @click.option(u'--separators-auto', u'separators', flag_value=u'auto', help=u'Show chunk separators when needed (default)', default=True)
+    @click.option(u'-s', u'--separators', u'separators', flag_value=u'always', help=u'Always show chunk separators')
+    @click.option(u'-S', u'--no-separators', u'separators', flag_value=u'never', help=u'Never show chunk separators')
+    @click.option(u'-c', u'--color', type=click.Choice([u'never', u'auto', u'always']), help=u'Color output', default=u'auto')
+    @click.option(u'-o/-O', u'--orig/--no-orig', help=u'Show original output interleaved with deltas')
+    @click.option(u'-z/-Z', u'--skip-zeros/--with-zeros', help=u'Skip all-zero deltas')
+    @click.option(u'-a/-A', u'--absolute/--relative', help=u'Show deltas from original value, not last')
+    @click.option(u'-n', u'--count', metavar=u'NUMBER', type=click.INT, help=u'Number of command runs (default: until Ctrl-C')
+    @click.option(u'-m', u'--max-formats', metavar=u'NUMBER', type=click.INT,
+        help=u'Forget least recently seen line formats above this many (default: unlimited)')
+    @click.option(u'-b/-B', u'--batch/--no-batch', help=u'Write output once per chunk instead of once per line')
+    @click.option(u'--max-delay', metavar=u'SECONDS', type=click.FLOAT, default=0.1,
+        help=u'Longest time output may be held back in batch mode (default: 0.1)')
+    @click.option(u'--overrun', type=click.Choice(Scheduler.OVERRUN_POLICIES), default=u'skip',
+        help=u'What to do when a command runs longer than the interval (default: skip)')
+    @click.option(u'--jitter', is_flag=True, help=u'Report scheduling jitter on exit')
+    @click.option(u'-r/-R', u'--rate/--no-rate', help=u'Show changes per second of measured time between samples')
+    @click.option(u'--file', u'files', metavar=u'PATH', multiple=True,
+        help=u'Reread this file every interval instead of running a command (may be repeated)')
+    @click.option(u'-p/-P', u'--stream/--no-stream',
+        help=u'Start the command once and read its output as it comes, like standard input')
+    @click.option(u'-d', u'--delimiter', metavar=u'REGEX', help=u'Start a new chunk on lines matching this (streaming input)')
+    @click.option(u'-g', u'--gap', metavar=u'SECONDS', type=click.FLOAT,
+        help=u'Start a new chunk after input is quiet this long (streaming input, default: interval)')
+    @click.option(u'-e', u'--command', u'commands', metavar=u'COMMAND', multiple=True,
+        help=u'Also run this shell command every interval, in parallel with the others (may be repeated)')
+    @click.option(u'--glob', u'globs', metavar=u'PATTERN', multiple=True,
+        help=u'Reread all files matching this every interval, e.g. /sys/block/*/stat (may be repeated)')
+    @click.option(u'--rescan', metavar=u'NUMBER', type=click.IntRange(1), default=10,
+        help=u'Look for new and removed files every this many intervals (default: 10)')
+    @click.option(u'--threads', metavar=u'NUMBER', type=click.IntRange(1), default=8,
+        help=u'Read this many files in parallel (default: 8)')
+    @click.option(u'--top', metavar=u'NUMBER', type=click.IntRange(1),
+        help=u'Only show this many lines that changed the most in each interval')
+    @click.option(u'--screen/--no-screen', help=u'Redraw a full screen in place instead of scrolling')
+    @click.option(u'--fps', u'max_fps', metavar=u'NUMBER', type=click.FLOAT, default=10,
+        help=u'Redraw the screen at most this many times per second (default: 10)')
+    @click.option(u'--output', u'output_format', type=click.Choice([u'text', u'json', u'csv']), default=u'text',
+        help=u'Write JSON Lines or CSV records with values, deltas and rates instead of text (default: text)')
+    @click.option(u'--record', metavar=u'FILE', type=click.File(u'ab'),
+        help=u'Append all input to this file in a compact binary form, for --replay')
+    @click.option(u'--replay', metavar=u'FILE', type=click.File(u'rb'), help=u'Read input recorded with --record')
+    @click.option(u'--speed', metavar=u'FACTOR', type=click.FLOAT, default=0,
+        help=u'Replay this many times faster than recorded (default: 0, as fast as possible)')
+    @click.option(u'-w', u'--window', metavar=u'NUMBER', type=click.IntRange(1),
+        help=u'Keep this many recent changes of every number for statistics')
+    @click.option(u'--stat', u'stats', type=click.Choice(Window.STATS), multiple=True,
+        help=u'Show this statistic over the window after every line (may be repeated, default: avg)')
+    @click.option(u'--stats-only', is_flag=True, help=u'Show the statistics instead of the changes')
+    @click.option(u'--counters', type=click.Choice(sorted(Parser.COUNTER_MARKS)),
+        help=u'Treat integers that go down as counters that wrapped around at 2^32/2^64 when they were close to it, '
+             u'and restarted from zero otherwise (wrap), always restarted from zero (reset) or just mark them (ignore)')
+    @click.option(u'-x/-X', u'--extended-numbers/--plain-numbers', u'extended',
+        help=u'Also read signs, hex, scientific notation and unit suffixes like 4GiB')
+    @click.option(u'-k', u'--key', u'key_columns', metavar=u'COLUMN', type=click.IntRange(1), multiple=True,
+        help=u'Match rows to the previous sample by this whitespace separated column, e.g. the PID (may be repeated)')
+    @click.option(u'--key-regex', metavar=u'REGEX',
+        help=u'Match rows to the previous sample by what this matches (or its groups)')
+    @click.option(u'--profile', is_flag=True,
+        help=u'Report where delta spends its own time and memory on exit')
+    @click.option(u'--profile-interval', metavar=u'SECONDS', type=click.FLOAT,
+        help=u'Also report that every this many seconds')
+    @click.option(u'--serve', metavar=u'ADDRESS',
+        help=u'Serve the latest values, deltas and rates as OpenMetrics on HOST:PORT or a Unix socket path '
+             u'instead of printing them')
+    @click.argument(u'cmd', nargs=-1, required=False)
+    def cli(cmd, timestamps, interval, flex, separators, color, orig, skip_zeros, absolute, count, max_formats, batch,
+            max_delay, overrun, jitter, rate, files, stream, delimiter, gap, commands, globs, rescan, threads,
+            top, screen, max_fps, output_format, record, replay, speed, window, stats, stats_only,
+            counters, extended, key_columns, key_regex, profile, profile_interval, serve):  # pragma: no cover
+        real_cli(sys.stdin, sys.stdout, cmd, timestamps, interval, flex, separators, color, orig, skip_zeros, absolute, count,
+                 max_formats, batch, max_delay, overrun, jitter, rate, files, stream, delimiter, gap, commands, globs, rescan,
+                 threads, top, screen, max_fps, output_format, record, replay, speed, window, stats, stats_only,
+                 counters, extended, key_columns, key_regex, profile, profile_interval, serve)
+
+    return cli
+
+
+FAST_OPTIONS = {
+    u'-i': (u'interval', float),
+    u'--interval': (u'interval', float),
+    u'-n': (u'count', int),
+    u'--count': (u'count', int),
+}
+
+
+def fast_args(argv):
+    # the common 'delta [-i SECONDS] [-n NUMBER] COMMAND...' parsed without
+    # click, which takes longer to import than a single sample takes to run;
+    # anything else, errors included, is left to click
+    if sys.version_info[0] == 2:
+        return None
+    args = dict(cmd=(), timestamps=False, interval=1.0, flex=True, separators=u'auto', color=u'auto', orig=False,
+                skip_zeros=False, absolute=False, count=None)
+    argv = list(argv)
+    while argv and argv[0].startswith(u'-'):
+        option = FAST_OPTIONS.get(argv.pop(0))
+        if option is None or not argv:
+            return None
+        name, kind = option
+        try:
+            value = kind(argv.pop(0))
+        except ValueError:
+            return None
+        if name == u'interval' and not value >= 0:
+            return None
+        args[name] = value
+    if any(arg.startswith(u'-') for arg in argv):
+        return None
+    args[u'cmd'] = tuple(argv)
+    return args
+
+
+def cli():  # pragma: no cover
+    args = fast_args(sys.argv[1:])
+    if args is None:
+        make_cli()()
+    else:
+        real_cli(sys.stdin, sys.stdout, **args)
 
-@click.command()
-@click.option(u'-t/-T', u'--timestamps/--no-timestamps', help=u'Show timestamps on all output lines')
-@click.option(u'-i', u'--interval', metavar=u'SECONDS', type=click.INT,
-    help=u'Interval between command runs', default=1)
-@click.option(u'-f/-F', u'--flex/--no-flex', help=u'Tweak column widths for better output (default is on)', default=True)
-@click.option(u'--separators-auto', u'separators', flag_value=u'auto', help=u'Show chunk separators when needed (default)', default=True)
-@click.option(u'-s', u'--separators', u'separators', flag_value=u'always', help=u'Always show chunk separators')
-@click.option(u'-S', u'--no-separators', u'separators', flag_value=u'never', help=u'Never show chunk separators')
-@click.option(u'-c', u'--color', type=click.Choice([u'never', u'auto', u'always']), help=u'Color output', default=u'auto')
-@click.option(u'-o/-O', u'--orig/--no-orig', help=u'Show original output interleaved with deltas')
-@click.option(u'-z/-Z', u'--skip-zeros/--with-zeros', help=u'Skip all-zero deltas')
-@click.option(u'-a/-A', u'--absolute/--relative', help=u'Show deltas from original value, not last')
-@click.option(u'-n', u'--count', metavar=u'NUMBER', type=click.INT, help=u'Number of command runs (default: until Ctrl-C')
-@click.argument(u'cmd', nargs=-1, required=False)
-def cli(cmd, timestamps, interval, flex, separators, color, orig, skip_zeros, absolute, count):  # pragma: no cover
-    real_cli(sys.stdin, sys.stdout, cmd, timestamps, interval, flex, separators, color, orig, skip_zeros, absolute, count)
 
 if __name__ == u'__main__':  # pragma: no cover
     cli()
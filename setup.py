@@ -1,13 +1,17 @@
+import sys
 from setuptools import setup
 
+install_requires = [
+    'Click',
+]
+if sys.version_info < (2, 7):
+    install_requires.append('ordereddict')
+
 setup(
     name='delta',
     version='0.1',
     py_modules=['delta'],
-    install_requires=[
-        'Click',
-        'ansicolors',
-    ],
+    install_requires=install_requires,
     entry_points='''
         [console_scripts]
         delta=delta:cli
@@ -10,6 +10,10 @@ import os
 import threading
 import signal
 import sys
+import tempfile
+import shutil
+import errno
+from io import BytesIO
 try:
     from io import StringIO
 except ImportError:
@@ -29,15 +33,12 @@ class StringChunkTestCase(unittest.TestCase):
     def test_format(self):
         c = delta.StringChunk(u'example')
         values = list(u'abcd')
-        self.assertEqual(c.format(values), u'example')
+        self.assertEqual(delta.Format([c]).format(values), u'example')
         self.assertEqual(values, list(u'abcd'))
 
-    def test_as_regex(self):
-        s = u'ex|amp[l]e'
-        c = delta.StringChunk(s)
-        rx = c.as_regex()
-        self.assertEqual(rx, u'ex\\|amp\\[l\\]e')
-        self.assertTrue(re.match(rx, s))
+    def test_as_template(self):
+        c = delta.StringChunk(u'a{b}')
+        self.assertEqual(c.as_template(0).format(), u'a{b}')
 
 
 class NumberChunkTestCase(unittest.TestCase):
@@ -89,32 +90,59 @@ class NumberChunkTestCase(unittest.TestCase):
         c = delta.NumberChunk.detect(u'  ', u'999', False)
         self.assertEqual(c.plain().format_str(), u' {0:4}')
 
-    def test_colorize_positive(self):
-        s = delta.NumberChunk.colorize(1, u'foo')
-        self.assertEqual(s, u'\x1b[32mfoo\x1b[0m')
+    def test_render_positive(self):
+        c = delta.NumberChunk.detect(u'', u'5', False, flex=False)
+        self.assertEqual(c.render(1), u'\x1b[32m+1\x1b[0m')
 
-    def test_colorize_negative(self):
-        s = delta.NumberChunk.colorize(-1, u'foo')
-        self.assertEqual(s, u'\x1b[31mfoo\x1b[0m')
+    def test_render_negative(self):
+        c = delta.NumberChunk.detect(u'', u'5', False, flex=False)
+        self.assertEqual(c.render(-1), u'\x1b[31m-1\x1b[0m')
 
-    def test_colorize_zero(self):
-        s = delta.NumberChunk.colorize(0, u'foo')
-        self.assertEqual(s, u'foo')
+    def test_render_zero(self):
+        c = delta.NumberChunk.detect(u'', u'5', False, flex=False)
+        self.assertEqual(c.render(0), u'+0')
+        self.assertEqual(c.render(1, use_colors=False), u'+1')
 
     def test_format_color(self):
         c = delta.NumberChunk.detect(u'  ', u'999', False)
-        values = [1, 2, 3, 4]
-        self.assertEqual(c.format(values, True), u'\x1b[32m   +1\x1b[0m')
-        self.assertEqual(values, [2, 3, 4])
+        self.assertEqual(c.render(1, True), u'\x1b[32m   +1\x1b[0m')
 
     def test_whitespace(self):
         c = delta.NumberChunk.detect(u'  ', u'999', False)
-        self.assertEqual(c.whitespace().format([0], False), u'   +0')
+        self.assertEqual(c.whitespace().render(0, False), u'   +0')
 
-    def test_as_regex(self):
+    def test_as_template(self):
         c = delta.NumberChunk.detect(u'  ', u'999', False)
-        rx = re.compile(c.as_regex())
-        self.assertTrue(rx.match('  999'))
+        self.assertEqual(c.as_template(3), u' {3:+4}')
+
+    def test_detect_extended(self):
+        for n, value, expected in [
+                (u'-5', 3, u' +3'),
+                (u'0x1f', 16, u' +0x10'),
+                (u'0X1F', -31, u' -0X1F'),
+                (u'1.50e3', 250.0, u' +2.50e2'),
+                (u'2E-03', 0.5, u' +5E-01'),
+                (u'0x1F', 16, u' +0x10'),
+                (u'12.3K', 100, u' +0.1K'),
+                (u'4GiB', -2 ** 30, u' -1GiB'),
+                (u'512B', 1, u'  +1B')]:
+            c = delta.NumberChunk.detect(u' ', n, False)
+            self.assertEqual(c.render(value, False), expected)
+
+    def test_detect_exa(self):
+        for n, expected in [(u'4EiB', u' +1EiB'), (u'1E', u' +1E')]:
+            c = delta.NumberChunk.detect(u' ', n, False)
+            self.assertEqual(c.scale, 1024 ** 6 if u'i' in n else 1000 ** 6)
+            self.assertEqual(c.render(c.scale, False), expected)
+
+    def test_hex_fractions(self):
+        # rates and averages of hex numbers fall back to decimal
+        c = delta.NumberChunk.detect(u' ', u'0x1f', False)
+        self.assertEqual(c.render(2.5, False), u' +2.5')
+        self.assertEqual(c.render(16.0, False), u' +0x10')
+        self.assertEqual(c.render(-2.5, True), u'\x1b[31m -2.5\x1b[0m')
+        f = delta.Format([delta.StringChunk(u'x'), c], colors=False)
+        self.assertEqual(f.format([0.25]), u'x +0.25')
 
 
 class FormatTestCase(unittest.TestCase):
@@ -154,6 +182,27 @@ class FormatTestCase(unittest.TestCase):
         self.assertEqual(f.whitespace().format(values), u'     \x1b[32m  +1\x1b[0m')
         self.assertEqual(values, [1, 2, 3, 4])
 
+    def test_variants_cached(self):
+        f = delta.Format([
+            delta.StringChunk(u'hello'),
+            delta.NumberChunk.detect(u' ', u'999', False),
+        ])
+        self.assertIs(f.plain(), f.plain())
+        self.assertIs(f.plain().plain(), f.plain())
+        self.assertIs(f.whitespace(), f.whitespace())
+
+    def test_format_many_values(self):
+        chunks = [delta.StringChunk(u'cpu')]
+        for i in range(256):
+            chunks.append(delta.NumberChunk.detect(u' ', u'10', False))
+        f = delta.Format(chunks + [delta.StringChunk(u' {x}\n')])
+        values = list(range(-128, 128))
+        self.assertEqual(f.format(values, False), u''.join(
+            [u'cpu'] + [u' {0:+2}'.format(v) for v in values] + [u' {x}\n']))
+        self.assertEqual(f.format(values), u''.join(
+            [u'cpu'] + [(u'\x1b[32m {0:+2}\x1b[0m' if v > 0 else u'\x1b[31m {0:+2}\x1b[0m' if v < 0 else u' {0:+2}').format(v)
+                        for v in values] + [u' {x}\n']))
+
 
 class ParserTestCase(unittest.TestCase):
     def test_num_int(self):
@@ -184,6 +233,14 @@ class ParserTestCase(unittest.TestCase):
         self.assertIsNone(deltas)
         self.assertListEqual(values, [908638.24, 1797254.54])
 
+    def test_parse_extended(self):
+        parser = delta.Parser(use_colors=False, extended=True)
+        line = u'1.5e3 2E-3 +5 0x1F 0X1f 12.3K -7 1.50E+03 3e10\n'
+        fmt, deltas, values = parser.parse(line)
+        self.assertEqual(fmt.format(values), line)
+        self.assertEqual(fmt.plain().format(values), line)
+        self.assertIsNone(deltas)
+
     def test_parse_flex(self):
         parser = delta.Parser(use_colors=False)
         line = u'0.05 0.08 0.06 1/175 19537'
@@ -218,6 +275,367 @@ class ParserTestCase(unittest.TestCase):
         self.assertEqual(values, [1002])
         self.assertEqual(deltas, [2])
 
+    def test_skeleton(self):
+        elts = delta.Parser.number_re.split(u'pgfault 123 x 4.5\n')
+        self.assertEqual(delta.Parser.skeleton(elts), u'pgfault\0 x\0')
+
+    def test_process_index(self):
+        parser = delta.Parser(use_colors=False)
+        parser.process(u'pgfault 100\n')
+        parser.process(u'pgmajfault 10\n')
+        fmt, deltas, values = parser.process(u'pgmajfault    12\n')
+        self.assertEqual(deltas, [2])
+        self.assertIs(parser.formats[u'pgmajfault\0'], fmt)
+        fmt, deltas, values = parser.process(u'pgfault 103\n')
+        self.assertEqual(deltas, [3])
+        self.assertEqual(len(parser.formats), 2)
+
+    def test_process_max_formats(self):
+        parser = delta.Parser(use_colors=False, max_formats=2)
+        parser.process(u'a 1\n')
+        parser.process(u'b 1\n')
+        parser.process(u'a 2\n')
+        parser.process(u'c 1\n')
+        self.assertEqual(parser.evicted, 1)
+        self.assertEqual(list(parser.formats), [u'a\0', u'c\0'])
+        self.assertEqual(len(parser.values), 2)
+        _, deltas, _ = parser.process(u'b 2\n')
+        self.assertIsNone(deltas)
+        self.assertEqual(parser.evicted, 2)
+
+    def test_process_rate(self):
+        parser = delta.Parser(use_colors=False, rate=True)
+        parser.timestamp = delta.Timestamp(10.0)
+        parser.process(u'a 1000 0.5\n')
+        parser.timestamp = delta.Timestamp(12.0)
+        _, deltas, values = parser.process(u'a 1005 1.5\n')
+        self.assertEqual(values, [1005, 1.5])
+        self.assertEqual(deltas, [2.5, 0.5])
+        self.assertEqual(parser.elapsed, 2.0)
+        parser.timestamp = delta.Timestamp(15.0)
+        _, deltas, _ = parser.process(u'a 1006 1.5\n')
+        self.assertEqual(deltas, [0.33, 0.0])
+
+    def test_process_rate_same_sample(self):
+        parser = delta.Parser(use_colors=False, rate=True)
+        parser.timestamp = delta.Timestamp(10.0)
+        parser.process(u'a 1000\n')
+        _, deltas, _ = parser.process(u'a 1005\n')
+        self.assertEqual(deltas, [5])
+
+    def test_process_rate_absolute(self):
+        parser = delta.Parser(use_colors=False, rate=True, absolute=True)
+        parser.timestamp = delta.Timestamp(10.0)
+        parser.process(u'a 1000\n')
+        parser.timestamp = delta.Timestamp(11.0)
+        parser.process(u'a 1010\n')
+        parser.timestamp = delta.Timestamp(14.0)
+        _, deltas, _ = parser.process(u'a 1040\n')
+        self.assertEqual(deltas, [10])
+
+    def test_process_sources(self):
+        parser = delta.Parser(use_colors=False)
+        parser.source = u'rx_bytes'
+        parser.process(u'100\n')
+        parser.source = u'tx_bytes'
+        parser.process(u'5000\n')
+        parser.source = u'rx_bytes'
+        _, deltas, _ = parser.process(u'110\n')
+        self.assertEqual(deltas, [10])
+        self.assertIn((u'tx_bytes', u'\0'), parser.formats)
+
+    def test_window(self):
+        window = delta.Window(2, 3)
+        window.add([1, 10])
+        self.assertEqual(window.stat(u'avg'), [1, 10])
+        window.add([2, -10])
+        window.add([4, 0.5])
+        window.add([3, 10])
+        self.assertEqual(window.stat(u'avg'), [3, 0.17])
+        self.assertEqual(window.stat(u'min'), [2, -10])
+        self.assertEqual(window.stat(u'max'), [4, 10])
+        self.assertEqual(window.stat(u'p50'), [3, 0.5])
+        self.assertEqual(window.stat(u'p99'), [4, 10])
+        self.assertEqual(len(window.ring), 6)
+
+    def test_process_window(self):
+        parser = delta.Parser(use_colors=False, window=2)
+        for text in [u'a 1\nb 10\n', u'a 2\nb 20\n', u'a 4\nb 30\n', u'a 10\nb 40\n']:
+            results = parser.process_text(text)
+        fmt_a, fmt_b = [fmt for fmt, _, _ in results]
+        self.assertEqual(parser.windows[fmt_a].stat(u'avg'), [4])
+        self.assertEqual(parser.windows[fmt_b].stat(u'avg'), [10])
+        parser.process(u'a 11\n')
+        self.assertEqual(parser.windows[fmt_a].stat(u'max'), [6])
+
+    def test_counters(self):
+        for policy, expected, kinds in [
+                (u'ignore', [-4294967096, -10, -1.0], [u'drop', u'drop', None]),
+                # 15 -> 5 is nowhere near 2^32, so that one was reset
+                (u'wrap', [200, 5, -1.0], [u'wrap', u'reset', None]),
+                (u'reset', [100, 5, -1.0], [u'reset', u'reset', None])]:
+            parser = delta.Parser(use_colors=False, counters=policy)
+            parser.process(u'4294967196 15 1.5\n')
+            _, deltas, _ = parser.process(u'0000000100 5 0.5\n')
+            self.assertEqual(deltas, expected)
+            self.assertEqual([getattr(d, u'kind', None) for d in deltas], kinds)
+
+        parser = delta.Parser(use_colors=False, counters=u'wrap')
+        parser.process(u'18446744073709551615 5000000000\n')
+        _, deltas, _ = parser.process(u'5 10\n')
+        self.assertEqual(deltas, [6, 10])
+        self.assertEqual([d.kind for d in deltas], [u'wrap', u'reset'])
+
+    def test_counters_layout_rate(self):
+        parser = delta.Parser(use_colors=False, counters=u'reset', rate=True)
+        parser.timestamp = delta.Timestamp(10.0)
+        parser.process_text(u'a 10\nb 20\n')
+        parser.timestamp = delta.Timestamp(12.0)
+        parser.process_text(u'a 14\nb 30\n')
+        parser.timestamp = delta.Timestamp(14.0)
+        (_, a, _), (_, b, _) = parser.process_text(u'a 16\nb 8\n')
+        self.assertEqual((a, b), ([1.0], [4.0]))
+        self.assertIsInstance(b[0], delta.Marked)
+        self.assertNotIsInstance(a[0], delta.Marked)
+
+    def test_process_keyed(self):
+        parser = delta.Parser(use_colors=False, key_columns=(1,))
+        parser.process_text(u'PID RSS\n 10 100\n 20 200\n')
+        parser.tick()
+        results = parser.process_text(u'PID RSS\n 20 210\n 30 300\n 10 150\n')
+        parser.tick()
+        self.assertEqual([(fmt.format(values if deltas is None else deltas), deltas) for fmt, deltas, values in results], [
+            (u'PID RSS\n', []),
+            (u' 20 +10\n', [10]),
+            (u' 30 300\n', None),
+            (u' 10 +50\n', [50])])
+
+        # 20 (and the header) are gone, 20 comes back as a new row
+        parser.process_text(u' 10 150\n 30 300\n')
+        parser.tick()
+        self.assertEqual(len(parser.formats), 2)
+        _, deltas, _ = parser.process(u' 20 220\n')
+        self.assertIsNone(deltas)
+
+    def test_process_keyed_repadded(self):
+        parser = delta.Parser(use_colors=False, key_columns=(1,))
+        parser.process_text(u'  99 500\n   7 100\n')
+        parser.tick()
+        results = parser.process_text(u' 99 700\n  7 100\n')
+        self.assertEqual([deltas for _, deltas, _ in results], [[200], [0]])
+        self.assertEqual(len(parser.formats), 2)
+
+    def test_process_key_regex(self):
+        parser = delta.Parser(use_colors=False, key_regex=r'^\s*(\S+):')
+        parser.process(u'  0:  10  20  IR-IO-APIC 2-edge timer\n')
+        parser.process(u'  1:   5   0  IR-IO-APIC 2-edge timer\n')
+        fmt, deltas, _ = parser.process(u'  0:  15  20  IR-IO-APIC 2-edge timer\n')
+        self.assertEqual(deltas, [5, 0, 0])
+        self.assertEqual(fmt.key, u'  0:{}{}  IR-IO-APIC{}-edge timer')
+
+    def test_forget(self):
+        parser = delta.Parser(use_colors=False)
+        parser.source = u'rx_bytes'
+        parser.process(u'100\n')
+        parser.source = u'tx_bytes'
+        parser.process(u'5000\n')
+        parser.forget(u'tx_bytes')
+        self.assertEqual(list(parser.formats), [(u'rx_bytes', u'\0')])
+        self.assertEqual(len(parser.values), 1)
+        _, deltas, _ = parser.process(u'6000\n')
+        self.assertIsNone(deltas)
+
+    def test_process_extended(self):
+        parser = delta.Parser(use_colors=False, extended=True)
+        fmt, _, values = parser.process(u'a -5 0x1f 1.5e3 2K 4GiB eth-1 5Gbps\n')
+        self.assertEqual(values, [-5, 31, 1500.0, 2000, 4 * 2 ** 30, 1, 5])
+        self.assertEqual(fmt.key, u'a{}{}{}{}{} eth-{}{}Gbps')
+        fmt, deltas, _ = parser.process(u'a +5 0x20 1.5e3 3K 3GiB eth-1 5Gbps\n')
+        self.assertEqual(deltas, [10, 1, 0.0, 1000, -2 ** 30, 0, 0])
+        self.assertEqual(fmt.format(deltas), u'a +10 +0x1 +0.0e0 +1K -1GiB eth-+0 +0Gbps\n')
+
+        # still plain by default
+        parser = delta.Parser(use_colors=False)
+        _, _, values = parser.process(u'a -5 0x1f\n')
+        self.assertEqual(values, [5, 0, 1])
+
+    def test_parse_number(self):
+        self.assertEqual(delta.parse_number(u'-0x10'), -16)
+        self.assertEqual(delta.parse_number(u'1.5k'), 1500.0)
+        self.assertEqual(delta.parse_number(u'2Ki'), 2048)
+        self.assertEqual(delta.Parser.num(u'1e3'), 1000.0)
+
+    def test_nums(self):
+        self.assertEqual(delta.Parser.nums([u'1', u'20']), [1, 20])
+        values = delta.Parser.nums([u'1', u'2.5'])
+        self.assertEqual(values, [1, 2.5])
+        self.assertIsInstance(values[0], int)
+
+    def test_process_text(self):
+        parser = delta.Parser(use_colors=False)
+        text = u'a 1\nno numbers\n\n 5 b 6.5\n'
+        results = list(parser.process_text(text))
+        self.assertEqual([values for _, _, values in results], [[1], [], [], [5, 6.5]])
+        self.assertEqual([deltas for _, deltas, _ in results], [None] * 4)
+
+        results = list(parser.process_text(u'a 3\nno numbers\n\n 7 b 6.0\nnew 1'))
+        self.assertEqual([deltas for _, deltas, _ in results], [[2], [], [], [2, -0.5], None])
+        self.assertEqual(results[3][2], [7, 6.0])
+        self.assertEqual(results[4][0].format(results[4][2]), u'new  1\n')
+
+    def test_process_text_matches_lines(self):
+        parser = delta.Parser(use_colors=False)
+        parser.process(u'a 1\n')
+        parser.process(u'2 b\n')
+        self.assertEqual(len(parser.formats), 2)
+        results = list(parser.process_text(u'a 2\n3 b\n'))
+        self.assertEqual([deltas for _, deltas, _ in results], [[1], [1]])
+        self.assertEqual(len(parser.formats), 2)
+        _, deltas, _ = parser.process(u'a 5\n')
+        self.assertEqual(deltas, [3])
+
+    def test_process_text_nul(self):
+        parser = delta.Parser(use_colors=False)
+        list(parser.process_text(u'a\x00 1\n'))
+        results = list(parser.process_text(u'a\x00 3\n'))
+        self.assertEqual(results[0][1], [2])
+
+    def test_process_text_over_max_formats(self):
+        parser = delta.Parser(use_colors=False, max_formats=1)
+        parser.process_text(u'a 1\nb 2\n')
+        parser = delta.Parser(use_colors=False, max_formats=2)
+        for _ in range(3):
+            results = parser.process_text(u'a 1\nb 2\nc 3\n')
+        self.assertEqual([deltas for _, deltas, _ in results], [None, None, None])
+        self.assertEqual(list(parser.formats), [u'b\0', u'c\0'])
+
+    def test_nul_is_not_a_number(self):
+        parser = delta.Parser(use_colors=False)
+        parser.process(u'a5b\n')
+        fmt, deltas, values = parser.process(u'a\0b\n')
+        self.assertIsNone(deltas)
+        self.assertEqual(fmt.format(values), u'a\0b\n')
+        parser.process(u'a\1\2b\n')
+        parser.process(u'a\0\1b 1\n')
+        self.assertEqual(len(parser.formats), 4)
+        _, deltas, _ = parser.process(u'a\0\1b 4\n')
+        self.assertEqual(deltas, [3])
+
+    def test_process_different_shape(self):
+        parser = delta.Parser(use_colors=False)
+        parser.process(u'hello 1\n')
+        _, deltas, values = parser.process(u'hello 1 2\n')
+        self.assertIsNone(deltas)
+        self.assertEqual(values, [1, 2])
+
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class DefaultEngineTestCase(unittest.TestCase):
+    def test_lazy(self):
+        # a single sample never needs an engine
+        parser = delta.Parser(use_colors=False)
+        parser.process_text(u'a 1\nb 2\n')
+        self.assertIsNone(parser.engine)
+        parser.process_text(u'a 2\nb 4\n')
+        self.assertIsNotNone(parser.engine)
+
+
+class EngineTestMixin(object):
+    def make_parser(self, **kwargs):
+        return delta.Parser(use_colors=False, engine=self.engine(), **kwargs)
+
+    def test_layout(self):
+        parser = self.make_parser()
+        parser.process_text(u'a 1\nb 2 3\n')
+        self.assertIsNone(parser.layouts[None].engine)
+        results = parser.process_text(u'a 11\nb 2 1\n')
+        self.assertIsInstance(parser.layouts[None].engine, self.engine)
+        self.assertEqual([deltas for _, deltas, _ in results], [[10], [0, -2]])
+        self.assertEqual([values for _, _, values in results], [[11], [2, 1]])
+        self.assertIsInstance(results[0][1][0], int)
+        self.assertEqual(results[0][0].format(results[0][1]), u'a +10\n')
+
+    def test_layout_change(self):
+        parser = self.make_parser()
+        parser.process_text(u'a 1\nb 2\n')
+        parser.process_text(u'a 2\nb 4\n')
+        results = parser.process_text(u'b 7\nc 1\na 3\n')
+        self.assertEqual([deltas for _, deltas, _ in results], [[3], None, [1]])
+        _, deltas, _ = parser.process(u'c 5\n')
+        self.assertEqual(deltas, [4])
+        results = parser.process_text(u'b 8\nc 6\na 5\n')
+        self.assertEqual([deltas for _, deltas, _ in results], [[1], [1], [2]])
+
+    def test_layout_absolute(self):
+        parser = self.make_parser(absolute=True)
+        parser.process_text(u'a 1\n')
+        parser.process_text(u'a 5\n')
+        results = parser.process_text(u'a 7\n')
+        self.assertEqual(results[0][1], [6])
+
+    def test_layout_rate(self):
+        parser = self.make_parser(rate=True)
+        parser.timestamp = delta.Timestamp(10.0)
+        parser.process_text(u'a 1 1\n')
+        parser.timestamp = delta.Timestamp(13.0)
+        results = parser.process_text(u'a 2 11\n')
+        self.assertEqual(results[0][1], [0.33, 3.33])
+
+    def test_layout_big_numbers(self):
+        parser = self.make_parser()
+        parser.process_text(u'a 1\n')
+        parser.process_text(u'a 3\n')
+        results = parser.process_text(u'a 18446744073709551615\n')
+        self.assertEqual(results[0][1], [18446744073709551612])
+        results = parser.process_text(u'a 2.5\n')
+        self.assertEqual(results[0][1], [2.5 - 18446744073709551615])
+
+    def test_layout_max_formats(self):
+        parser = self.make_parser(max_formats=3)
+        parser.process_text(u'a 1\nb 1\n')
+        parser.process_text(u'a 2\nb 2\n')
+        parser.source = u'other'
+        parser.process_text(u'c 1\n')
+        parser.source = None
+        parser.process_text(u'a 3\nb 3\n')
+        parser.source = u'other'
+        parser.process_text(u'd 1\n')
+        self.assertEqual(list(parser.formats), [u'a\0', u'b\0', (u'other', u'd\0')])
+        parser.source = None
+        results = parser.process_text(u'a 5\nb 4\n')
+        self.assertEqual([deltas for _, deltas, _ in results], [[2], [1]])
+
+    def test_layout_evicted(self):
+        parser = self.make_parser(max_formats=2)
+        parser.process_text(u'a 1\nb 1\n')
+        parser.source = u'other'
+        parser.process_text(u'c 1\n')
+        parser.source = None
+        results = parser.process_text(u'a 2\nb 2\n')
+        self.assertEqual([deltas for _, deltas, _ in results], [None, None])
+
+
+class ListEngineTestCase(EngineTestMixin, unittest.TestCase):
+    engine = delta.ListEngine
+
+
+@unittest.skipIf(numpy is None, u'NumPy not installed')
+class NumpyEngineTestCase(EngineTestMixin, unittest.TestCase):
+    engine = delta.NumpyEngine
+
+    def test_parse(self):
+        engine = delta.NumpyEngine()
+        self.assertEqual(engine.parse([u'1', u'007']).tolist(), [1, 7])
+        self.assertIsNone(engine.parse([u'1', u'1.5']))
+        self.assertIsNone(engine.parse([u'1', u'1234567890123456789']))
+        self.assertEqual(engine.parse([]).tolist(), [])
+        self.assertIsNone(engine.array([1, 1.5]))
+
 
 class TestPrinter(delta.Printer):
     @classmethod
@@ -430,8 +848,477 @@ hello  -2
 hello  -2
 ''')
 
+    def test_printer_stats(self):
+        sio = StringIO()
+        parser = delta.Parser(use_colors=False, window=2)
+        printer = TestPrinter(sio, timestamps=False, separators=False, orig=False, skip_zeros=False,
+                              windows=parser.windows, stats=(u'avg', u'max'))
+        for line in [u'hello 999\n', u'hello 1000\n', u'hello 1004\n']:
+            printer.output(*parser.process(line))
+        printer.stats_only = True
+        printer.output(*parser.process(u'hello 1004\n'))
+
+        self.assertEqual(sio.getvalue(), u'''hello 999
+hello  +1
+hello  +1 avg
+hello  +1 max
+hello  +4
+hello +2.5 avg
+hello  +4 max
+hello  +2 avg
+hello  +4 max
+''')
+
+    def test_printer_stats_no_numbers(self):
+        sio = StringIO()
+        parser = delta.Parser(use_colors=False, window=3)
+        printer = TestPrinter(sio, timestamps=False, separators=False, orig=False, skip_zeros=False,
+                              windows=parser.windows, stats=(u'avg', u'p99'))
+        for line in [u'header\n', u'hello 1\n', u'header\n', u'hello 3\n']:
+            printer.output(*parser.process(line))
+        printer.stats_only = True
+        for line in [u'header\n', u'hello 4\n']:
+            printer.output(*parser.process(line))
+
+        self.assertEqual(sio.getvalue(), u'''header
+hello  1
+header
+hello +2
+hello +2 avg
+hello +2 p99
+header
+hello +1.5 avg
+hello +2 p99
+''')
+
+    def test_printer_marks(self):
+        sio = StringIO()
+        parser = delta.Parser(use_colors=False, counters=u'wrap')
+        printer = TestPrinter(sio, timestamps=False, separators=False, orig=False, skip_zeros=False, marks=True)
+        for line in [u'hello 4294967295 1\n', u'hello 1 2\n', u'hello 2 3\n']:
+            printer.output(*parser.process(line))
+
+        self.assertEqual(sio.getvalue(), u'''hello 4294967295  1
+hello         +2 +1 [wrap]
+hello         +1 +1
+''')
+
+    def test_printer_top(self):
+        sio = StringIO()
+        printer = TestPrinter(sio, timestamps=False, separators=True, orig=False, skip_zeros=False, top=2)
+        f = delta.Format([
+            delta.StringChunk(u'hello'),
+            delta.NumberChunk.detect(u' ', u'999', False),
+            delta.StringChunk(u'\n'),
+        ], colors=False)
+        printer.separator()
+        printer.output(f.plain(), None, [999])
+        printer.output(f.plain(), None, [99])
+        printer.output(f.plain(), None, [1003])
+        printer.separator()
+        printer.output(f, [1], [1000])
+        printer.output(f, [-5], [94])
+        printer.output(f, [3], [1003])
+        printer.output(f, [5], [99])
+        # blocking mid-tick does not end the tick
+        printer.idle()
+        self.assertEqual(sio.getvalue(), u'hello 999\nhello  99\n')
+        printer.separator()
+        printer.output(f, [0], [99])
+        # a new line only gets the room the changes leave
+        printer.output(f.plain(), None, [7])
+        printer.label = u'other'
+        printer.output(f, [0], [1003])
+        printer.finish()
+
+        self.assertEqual(sio.getvalue(), u'''hello 999
+hello  99
+--- NOW
+hello  -5
+hello  +5
+--- NOW
+hello  +0
+other: hello  +0
+''')
+
+    def test_printer_batch(self):
+        sio = StringIO()
+        printer = TestPrinter(sio, timestamps=False, separators=True, orig=False, skip_zeros=False,
+                              batch=True, max_delay=60)
+        f = delta.Format([
+            delta.StringChunk(u'hello'),
+            delta.NumberChunk.detect(u' ', u'999', False),
+            delta.StringChunk(u'\n'),
+        ], colors=False)
+        printer.separator()
+        printer.output(f.plain(), None, [999])
+        printer.output(f.plain(), None, [99])
+        self.assertEqual(sio.getvalue(), u'')
+        printer.separator()
+        self.assertEqual(sio.getvalue(), u'''hello 999
+hello  99
+''')
+        printer.output(f, [1], [1000])
+        printer.flush()
+        self.assertEqual(sio.getvalue(), u'''hello 999
+hello  99
+--- NOW
+hello  +1
+''')
+
+    def test_printer_batch_limits(self):
+        sio = StringIO()
+        printer = TestPrinter(sio, timestamps=False, separators=False, orig=False, skip_zeros=False,
+                              batch=True, max_delay=60, buffer_size=20)
+        f = delta.Format([
+            delta.StringChunk(u'hello'),
+            delta.NumberChunk.detect(u' ', u'999', False),
+            delta.StringChunk(u'\n'),
+        ], colors=False)
+        printer.output(f.plain(), None, [999])
+        self.assertEqual(sio.getvalue(), u'')
+        printer.output(f.plain(), None, [998])
+        self.assertEqual(sio.getvalue(), u'hello 999\nhello 998\n')
+
+        printer.max_delay = 0
+        printer.output(f.plain(), None, [997])
+        self.assertEqual(sio.getvalue(), u'hello 999\nhello 998\nhello 997\n')
+
+    def test_printer_label(self):
+        sio = StringIO()
+        printer = TestPrinter(sio, timestamps=True, separators=False, orig=False, skip_zeros=False)
+        f = delta.Format([delta.NumberChunk.detect(u'', u'999', True), delta.StringChunk(u'\n')], colors=False)
+        printer.label = u'/proc/foo'
+        printer.output(f.plain(), None, [999])
+        self.assertEqual(sio.getvalue(), u'NOW: /proc/foo: 999\n')
+
+
+class TestScreenPrinter(delta.ScreenPrinter):
+    now = TestPrinter.now
+    time = 0.0
+
+    def clock(self):
+        return self.time
+
+
+class ScreenPrinterTestCase(unittest.TestCase):
+    def test_screen(self):
+        sio = StringIO()
+        printer = TestScreenPrinter(sio, max_fps=1)
+        f = delta.Format([
+            delta.StringChunk(u'a'),
+            delta.NumberChunk.detect(u' ', u'999', False),
+            delta.StringChunk(u' b'),
+            delta.NumberChunk.detect(u' ', u'1', False),
+            delta.StringChunk(u'\n'),
+        ], colors=False)
+        printer.output(f.plain(), None, [999, 1])
+        printer.separator()
+        self.assertEqual(sio.getvalue(), u'\x1b[H\x1b[2J\x1b[1;1HNOW\x1b[K\x1b[2;1Ha 999 b  1\x1b[K\x1b[3;1H')
+        sio.seek(0)
+        sio.truncate()
+
+        # too soon, merged into the next frame
+        printer.time = 0.5
+        printer.output(f, [1, 0], [1000, 1])
+        printer.separator()
+        printer.time = 1.5
+        printer.output(f, [1, 5], [1000, 6])
+        printer.separator()
+        # only the changed cells are rewritten
+        self.assertEqual(sio.getvalue(), u'\x1b[1;1HNOW\x1b[K\x1b[2;2H  +1\x1b[2;8H +5\x1b[3;1H')
+        sio.seek(0)
+        sio.truncate()
+
+        printer.label = u'x'
+        printer.output(f, [1, -5], [1001, 1])
+        printer.finish()
+        self.assertEqual(sio.getvalue(), u'\x1b[1;1HNOW\x1b[K\x1b[3;1Hx: a  +1 b -5\x1b[K\x1b[4;1H')
+
+    def test_scaled(self):
+        sio = StringIO()
+        printer = TestScreenPrinter(sio)
+        parser = delta.Parser(use_colors=False, extended=True)
+        printer.output(*parser.process(u'mem 2G\n'))
+        printer.finish()
+        self.assertIn(u'mem  2G\x1b[K', sio.getvalue())
+
+    def test_idle_rate_limited(self):
+        sio = StringIO()
+        printer = TestScreenPrinter(sio, max_fps=1)
+        feed = []
+        for i in range(20):
+            feed.extend([delta.separator, u'a {0}\n'.format(i), delta.idle])
+        delta.run(iter(feed), delta.Parser(use_colors=False), printer)
+        # the first frame, and the last one when the feed ends
+        self.assertEqual(sio.getvalue().count(u'NOW'), 2)
+        self.assertIn(u'+1', sio.getvalue())
+
+    def test_rows_reused(self):
+        sio = StringIO()
+        parser = delta.Parser(use_colors=False, key_columns=(1,))
+        printer = TestScreenPrinter(sio, height=3, parser=parser)
+        feed = []
+        for tick in range(6):
+            # two live rows every tick, but different ones every other tick
+            feed.append(delta.separator)
+            feed.extend(u'pid{0} {1}\n'.format(tick // 2 * 2 + i, tick) for i in range(2))
+        delta.run(iter(feed), parser, printer)
+        self.assertEqual(sorted(printer.rows.values()), [2, 3])
+        # rows are only dropped a tick later, so at most four were ever needed
+        self.assertEqual(printer.next_row, 6)
+        self.assertIn(u'pid5 +1', sio.getvalue())
+
+        # rows that are not reused are cleared
+        sio.seek(0)
+        sio.truncate()
+        printer.height = None
+        delta.run(iter([delta.separator, u'pid9 1\n', delta.separator]), parser, printer)
+        self.assertEqual(list(printer.rows.values()), [4])
+        self.assertIn(u'\x1b[3;1H\x1b[K', sio.getvalue())
+
+    def test_screen_height(self):
+        sio = StringIO()
+        printer = TestScreenPrinter(sio, height=2)
+        f = delta.Format([delta.StringChunk(u'a'), delta.NumberChunk.detect(u' ', u'1', False)], colors=False)
+        printer.output(f.plain(), None, [1])
+        printer.label = u'x'
+        printer.output(f.plain(), None, [1])
+        printer.finish()
+        self.assertEqual(sio.getvalue(), u'\x1b[H\x1b[2J\x1b[1;1HNOW\x1b[K\x1b[2;1Ha  1\x1b[K\x1b[3;1H')
+
+
+class TestRecordPrinter(delta.RecordPrinter):
+    @classmethod
+    def wallclock(cls):
+        return 100.5
+
+
+class RecordPrinterTestCase(unittest.TestCase):
+    def run_records(self, style):
+        sio = StringIO()
+        parser = delta.Parser(use_colors=False)
+        printer = TestRecordPrinter(sio, parser, style, batch=False)
+        parser.timestamp = delta.Timestamp(10.0)
+        printer.separator()
+        printer.output(*parser.process(u'a 1 "b" 2\n'))
+        parser.timestamp = delta.Timestamp(12.0)
+        printer.separator()
+        printer.label = u'x'
+        printer.output(*parser.process(u'a 5 "b" 2.5\n'))
+        printer.finish()
+        return sio.getvalue()
+
+    def test_json(self):
+        self.assertEqual(self.run_records(u'json'), u'''\
+{"time": 100.5, "source": null, "key": "a{} \\"b\\"{}", "values": [1, 2], "deltas": null, "rates": null}
+{"time": 100.5, "source": "x", "key": "a{} \\"b\\"{}", "values": [5, 2.5], "deltas": [4, 0.5], "rates": [2.0, 0.25]}
+''')
+
+    def test_csv(self):
+        self.assertEqual(self.run_records(u'csv'), u'''\
+time,source,key,index,value,delta,rate\r
+100.5,"","a{} ""b""{}",0,1,,\r
+100.5,"","a{} ""b""{}",1,2,,\r
+100.5,"x","a{} ""b""{}",0,5,4,2.0\r
+100.5,"x","a{} ""b""{}",1,2.5,0.5,0.25\r
+''')
+
+    def test_rates_per_line(self):
+        # each line gets the rate over its own interval, and a new line
+        # at the end of the chunk does not get in the way
+        sio = StringIO()
+        parser = delta.Parser(use_colors=False)
+        printer = TestRecordPrinter(sio, parser, batch=False)
+        parser.timestamp = delta.Timestamp(10.0)
+        parser.process(u'b 1\n')
+        parser.timestamp = delta.Timestamp(11.0)
+        parser.process_text(u'a 1\n')
+        parser.timestamp = delta.Timestamp(12.0)
+        for result in parser.process_text(u'a 3\nb 5\nc 1\n'):
+            printer.output(*result)
+        printer.finish()
+        self.assertEqual([line.split(u'"rates": ')[1] for line in sio.getvalue().splitlines()],
+                         [u'[2.0]}', u'[2.0]}', u'null}'])
+
+    def test_sample_time(self):
+        sio = StringIO()
+        parser = delta.Parser(use_colors=False)
+        printer = delta.RecordPrinter(sio, parser, batch=False)
+        parser.timestamp = delta.Timestamp(delta.monotonic() - 5)
+        printer.separator()
+        printer.output(*parser.process(u'a 1\n'))
+        record_time = float(sio.getvalue().split(u'"time": ')[1].split(u',')[0])
+        self.assertAlmostEqual(record_time, time.time() - 5, delta=1)
+
+    def test_prefixes_pruned(self):
+        sio = StringIO()
+        parser = delta.Parser(use_colors=False, max_formats=2)
+        printer = TestRecordPrinter(sio, parser, batch=False)
+        for i in range(100):
+            printer.output(*parser.process(u'{0} 1\n'.format(u'x' * (i + 1))))
+        self.assertLessEqual(len(printer.prefixes), 4)
+        self.assertIn((None, u'x' * 100 + u'{}'), printer.prefixes)
+
+
+class MetricsPrinterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.parser = delta.Parser(use_colors=False)
+        self.printer = delta.MetricsPrinter(StringIO(), self.parser)
+
+    def tick(self, timestamp, *lines):
+        self.parser.timestamp = delta.Timestamp(timestamp)
+        self.printer.separator()
+        for line in lines:
+            self.printer.output(*self.parser.process(line))
+
+    def test_page(self):
+        self.tick(10.0, u'a 1 "b" 2\n')
+        self.printer.label = u'x'
+        self.tick(12.0, u'a 5 "b" 2.5\n')
+        # the second tick is not on the page until it is done
+        self.assertNotIn(b'source="x"', self.printer.page)
+        self.printer.finish()
+        self.assertEqual(self.printer.page.decode(u'utf-8'), u'''\
+# TYPE delta_value gauge
+# HELP delta_value Last value of the number
+delta_value{source="",key="a{} \\"b\\"{}",index="0"} 1
+delta_value{source="",key="a{} \\"b\\"{}",index="1"} 2
+delta_value{source="x",key="a{} \\"b\\"{}",index="0"} 5
+delta_value{source="x",key="a{} \\"b\\"{}",index="1"} 2.5
+# TYPE delta_delta gauge
+# HELP delta_delta Change of the number over the last interval
+delta_delta{source="x",key="a{} \\"b\\"{}",index="0"} 4
+delta_delta{source="x",key="a{} \\"b\\"{}",index="1"} 0.5
+# TYPE delta_rate gauge
+# HELP delta_rate Change of the number per second over the last interval
+delta_rate{source="x",key="a{} \\"b\\"{}",index="0"} 2.0
+delta_rate{source="x",key="a{} \\"b\\"{}",index="1"} 0.25
+# EOF
+''')
+
+    def test_page_on_idle(self):
+        pages = []
+
+        class WatchedPrinter(delta.MetricsPrinter):
+            def idle(self):
+                super(WatchedPrinter, self).idle()
+                pages.append(self.page)
+
+        printer = WatchedPrinter(StringIO(), self.parser)
+        feed = delta.command_feed((u'echo a 1',), 0, 2, markers=True, blocks=True)
+        delta.run(feed, self.parser, printer)
+        # every tick is on the page once the feed goes idle after it
+        self.assertEqual(len(pages), 2)
+        self.assertIn(b'delta_value{source="",key="a{}",index="0"} 1\n', pages[0])
+        self.assertNotIn(b'delta_delta{', pages[0])
+        self.assertIn(b'delta_delta{source="",key="a{}",index="0"} 0\n', pages[1])
+
+    def test_vanished_series(self):
+        self.tick(10.0, u'a 1\n', u'b 1\n')
+        self.tick(11.0, u'a 2\n')
+        self.printer.finish()
+        self.assertIn(b'key="b{}"', self.printer.page)
+        self.tick(12.0, u'a 3\n')
+        self.printer.finish()
+        self.assertNotIn(b'key="b{}"', self.printer.page)
+
+    def test_rates_with_new_line(self):
+        self.tick(10.0, u'a 1\n')
+        self.parser.timestamp = delta.Timestamp(12.0)
+        self.printer.separator()
+        for result in self.parser.process_text(u'a 5\nb 1\n'):
+            self.printer.output(*result)
+        self.printer.finish()
+        self.assertIn(b'delta_rate{source="",key="a{}",index="0"} 2.0\n', self.printer.page)
+
+    def test_evicted_series(self):
+        self.parser.max_formats = 1
+        self.tick(10.0, u'a 1\n')
+        self.tick(11.0, u'b 1\n', u'a 2\n')
+        self.printer.finish()
+        self.assertEqual(self.printer.page.count(b'delta_value{source="",key="a{}"'), 1)
+        self.assertLessEqual(len(self.printer.labels), 2)
+
+    def test_number(self):
+        self.assertEqual(delta.metric_number(3), u'3')
+        self.assertEqual(delta.metric_number(0.1), u'0.1')
+        self.assertEqual(delta.metric_number(float(u'nan')), u'NaN')
+        self.assertEqual(delta.metric_number(float(u'-inf')), u'-Inf')
+        self.assertEqual(delta.metric_escape(u'a\\b"c\nd'), u'a\\\\b\\"c\\nd')
+
+    def test_address(self):
+        self.assertEqual(delta.parse_address(u'localhost:9100'), (u'localhost', 9100))
+        self.assertEqual(delta.parse_address(u':9100'), (u'127.0.0.1', 9100))
+        self.assertEqual(delta.parse_address(u'[::1]:9100'), (u'::1', 9100))
+        self.assertEqual(delta.parse_address(u'/run/delta.sock'), u'/run/delta.sock')
+        self.assertRaises(ValueError, delta.parse_address, u'localhost')
+
+    def test_serve_socket_path(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, u'metrics.txt')
+            with open(path, u'w') as fp:
+                fp.write(u'keep me')
+            self.assertRaises(IOError, delta.serve_metrics, path, self.printer)
+            self.assertTrue(os.path.isfile(path))
+
+            path = os.path.join(tmpdir, u'metrics.sock')
+            for _ in range(2):
+                # a stale socket is replaced, a live one is not
+                server = delta.serve_metrics(path, self.printer)
+                with self.assertRaises(IOError) as cm:
+                    delta.serve_metrics(path, self.printer)
+                self.assertEqual(cm.exception.errno, errno.EADDRINUSE)
+                server.shutdown()
+                server.server_close()
+
+            # the command line removes its socket when done
+            delta.real_cli(StringIO(), StringIO(), (), False, 1, True, u'auto', u'never', False, False, False, None,
+                           replay=BytesIO(), serve=path)
+            self.assertFalse(os.path.exists(path))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_serve(self):
+        try:
+            from urllib.request import urlopen
+            from urllib.error import HTTPError
+        except ImportError:  # python 2
+            from urllib2 import urlopen, HTTPError
+        self.tick(10.0, u'a 1\n')
+        self.printer.finish()
+        server = delta.serve_metrics((u'127.0.0.1', 0), self.printer)
+        try:
+            url = u'http://127.0.0.1:{0}'.format(server.server_address[1])
+            response = urlopen(url + u'/metrics')
+            self.assertEqual(response.headers[u'Content-Type'], delta.MetricsPrinter.CONTENT_TYPE)
+            self.assertEqual(response.read(), self.printer.page)
+            self.assertRaises(HTTPError, urlopen, url + u'/other')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
 
 class FeedTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_file(self, name, text):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, u'w') as fp:
+            fp.write(text)
+        return path
+
     def test_fd_feed(self):
         def threadfunc(wfd):
             wfd.write(u'hello\n')
@@ -460,6 +1347,285 @@ class FeedTestCase(unittest.TestCase):
         thd.join()
         rfd.close()
 
+    def test_fd_feed_markers(self):
+        r, w = os.pipe()
+        rfd = os.fdopen(r, u'r')
+        os.write(w, b'hello\nhel')
+
+        feed = delta.fd_feed(rfd, 0.1, markers=True)
+        self.assertIsInstance(next(feed), delta.Timestamp)
+        self.assertEqual(next(feed), u'hello\n')
+        self.assertIs(next(feed), delta.idle)
+        os.write(w, b'lo\nbye')
+        os.close(w)
+        self.assertIsInstance(next(feed), delta.Timestamp)
+        self.assertEqual(next(feed), u'hello\n')
+        self.assertEqual(next(feed), u'bye')
+        self.assertRaises(StopIteration, next, feed)
+        rfd.close()
+
+    def test_fd_feed_delimiter(self):
+        r, w = os.pipe()
+        rfd = os.fdopen(r, u'r')
+        os.write(w, b'procs\n1 2\nprocs\n3 4\n')
+        os.close(w)
+
+        feed = delta.fd_feed(rfd, 0.01, delimiter=re.compile(u'^procs'))
+        self.assertEqual(list(feed), [
+            delta.separator, u'procs\n', u'1 2\n',
+            delta.separator, u'procs\n', u'3 4\n'])
+        rfd.close()
+
+    def test_fd_feed_no_fileno_delimiter(self):
+        feed = delta.fd_feed(StringIO(u'a\n1\na\n2\n'), 5, delimiter=re.compile(u'a'))
+        self.assertEqual(list(feed), [delta.separator, u'a\n', u'1\n', delta.separator, u'a\n', u'2\n'])
+
+    def test_stream_feed(self):
+        feed = delta.stream_feed((u'echo 1; sleep 0.2; echo 2',), 0.1)
+        self.assertEqual(list(feed), [u'1\n', delta.separator, u'2\n'])
+
+    def test_stream_feed_delimiter(self):
+        feed = delta.stream_feed([u'printf', u'tick\\n1\\ntick\\n2\\n'], 5, re.compile(u'^tick'))
+        self.assertEqual(list(feed), [
+            delta.separator, u'tick\n', u'1\n',
+            delta.separator, u'tick\n', u'2\n'])
+
+    def test_stream_feed_close(self):
+        feed = delta.stream_feed((u'yes 1',), 5)
+        self.assertEqual(next(feed), u'1\n')
+        feed.close()
+
+    def test_fd_feed_blocks(self):
+        r, w = os.pipe()
+        rfd = os.fdopen(r, u'r')
+        os.write(w, b'a 1\nb 2\nc')
+        os.close(w)
+
+        items = list(delta.fd_feed(rfd, 5, blocks=True))
+        self.assertEqual(items[0].text, u'a 1\nb 2\n')
+        self.assertEqual(items[1:], [u'c'])
+        rfd.close()
+
+    def test_fd_feed_no_fileno(self):
+        feed = delta.fd_feed(StringIO(u'hello\nbye\n'), 5)
+        self.assertEqual(list(feed), [u'hello\n', u'bye\n'])
+
+    def test_command_feed_markers(self):
+        feed = delta.command_feed([u'/bin/echo', u'hello'], 0.1, 1, markers=True)
+        items = list(feed)
+        self.assertIs(items[0], delta.separator)
+        self.assertIsInstance(items[1], delta.Timestamp)
+        self.assertEqual(items[2:], [u'hello\n', delta.idle])
+
+    def test_file_reader(self):
+        text = u''.join(u'counter{0} {0}\n'.format(i) for i in range(1000))
+        path = self.write_file(u'big', text)
+        reader = delta.FileReader(path, size=16)
+        self.assertEqual(bytes(reader.read()).decode(u'ascii'), text)
+        buf = reader.buf
+        self.write_file(u'big', u'short\n')
+        self.assertEqual(bytes(reader.read()), b'short\n')
+        self.assertIs(reader.buf, buf)
+        reader.close()
+
+    def test_file_reader_grows(self):
+        # the data of the last read must not keep the buffer from growing
+        path = self.write_file(u'grows', u'a 1\n' * 10)
+        reader = delta.FileReader(path, size=64)
+        data = reader.read()
+        self.write_file(u'grows', u'a 1\n' * 3000)
+        self.assertEqual(len(reader.read()), 12000)
+        self.assertEqual(len(data), 40)
+        reader.close()
+
+    def test_file_feed(self):
+        path = self.write_file(u'one', u'hello 1\nworld 2\n')
+        feed = delta.file_feed([path], 0.1, 2)
+        self.assertEqual(list(feed), [
+            delta.separator, u'hello 1\n', u'world 2\n',
+            delta.separator, u'hello 1\n', u'world 2\n'])
+
+    def test_file_feed_missing(self):
+        # reported when the feed is made, not when it is first read
+        one = self.write_file(u'one', u'1\n')
+        missing = os.path.join(self.tmpdir, u'missing')
+        self.assertRaises(EnvironmentError, delta.file_feed, [one, missing], 0.1)
+        self.assertRaises(EnvironmentError, delta.multi_feed, [(u'echo', u'1')], [one, missing], 0.1)
+
+    def test_file_feed_sources(self):
+        one = self.write_file(u'one', u'1\n')
+        two = self.write_file(u'two', u'2\n')
+        feed = delta.file_feed([one, two], 0.1, 1, markers=True)
+        items = list(feed)
+        self.assertIs(items[0], delta.separator)
+        self.assertIsInstance(items[1], delta.Timestamp)
+        self.assertEqual(items[2].name, one)
+        self.assertEqual(items[3], u'1\n')
+        self.assertIsInstance(items[4], delta.Timestamp)
+        self.assertEqual(items[5].name, two)
+        self.assertEqual(items[6:], [u'2\n', delta.idle])
+
+    def test_glob_feed(self):
+        self.write_file(u'one', u'1\n')
+        pattern = os.path.join(self.tmpdir, u'*')
+
+        def names(item):
+            if isinstance(item, delta.Source):
+                return u'+' + os.path.basename(item.name)
+            if isinstance(item, delta.Gone):
+                return u'-' + os.path.basename(item.name)
+            return item
+
+        feed = delta.glob_feed([pattern], 0.1, 5, rescan=2, threads=2)
+        items = [names(next(feed)) for _ in range(3)]
+        self.assertEqual(items, [delta.separator, u'+one', u'1\n'])
+
+        # new files are only picked up on a rescan
+        self.write_file(u'two', u'2\n')
+        items = [names(next(feed)) for _ in range(3)]
+        self.assertEqual(items, [delta.separator, u'+one', u'1\n'])
+        items = [names(next(feed)) for _ in range(5)]
+        self.assertEqual(items, [delta.separator, u'+one', u'1\n', u'+two', u'2\n'])
+
+        # an open file stays readable after unlinking until the next rescan
+        os.unlink(os.path.join(self.tmpdir, u'one'))
+        self.assertEqual([names(item) for item in feed], [
+            delta.separator, u'+one', u'1\n', u'+two', u'2\n',
+            u'-one', delta.separator, u'+two', u'2\n'])
+
+    @unittest.skipUnless(os.path.isdir(u'/proc/self/fd'), u'needs /proc')
+    def test_glob_feed_max_open(self):
+        for i in range(5):
+            self.write_file(u'f{0}'.format(i), u'{0}\n'.format(i))
+        os.symlink(os.path.join(self.tmpdir, u'missing'), os.path.join(self.tmpdir, u'broken'))
+        log = StringIO()
+
+        def open_here():
+            fds = os.listdir(u'/proc/self/fd')
+            return sum(1 for fd in fds if os.path.realpath(u'/proc/self/fd/' + fd).startswith(self.tmpdir))
+
+        feed = delta.glob_feed([os.path.join(self.tmpdir, u'*')], 0.1, 2, threads=1, max_open=2, log=log)
+        items = []
+        for item in feed:
+            items.append(item)
+            self.assertLessEqual(open_here(), 2)
+        lines = [item for item in items if type(item) is type(u'')]
+        self.assertEqual(sorted(lines), sorted([u'{0}\n'.format(i) for i in range(5)] * 2))
+        self.assertEqual(open_here(), 0)
+        self.assertTrue(log.getvalue().startswith(u'delta: cannot open 1 files, e.g. '))
+        self.assertIn(u'broken: No such file or directory', log.getvalue())
+
+    def test_record_replayed(self):
+        # a replay recorded again keeps its original wall times
+        first, second = os.path.join(self.tmpdir, u'first'), os.path.join(self.tmpdir, u'second')
+        with open(first, u'wb') as fp:
+            list(delta.record_feed(iter([delta.separator, u'a 1\n', delta.separator, u'a 2\n']), fp))
+        with open(first, u'rb') as fp:
+            replayed = list(delta.replay_feed(fp, markers=True))
+        with open(first, u'rb') as fp:
+            with open(second, u'wb') as out:
+                self.assertEqual(list(delta.record_feed(delta.replay_feed(fp, markers=True), out)), replayed)
+        with open(second, u'rb') as fp:
+            self.assertEqual(list(delta.replay_feed(fp, markers=True)), replayed)
+
+    def test_record_replay(self):
+        items = [
+            delta.separator, delta.Timestamp(5.0), delta.Source(u'one'),
+            u'a 1 b 007 c  2.50\n', u'no numbers\n', u'nul \0 1\n', delta.Block(u'x 300\ny 4'), delta.idle,
+            delta.separator, delta.Timestamp(6.0), delta.Source(u'two'), u'a 2 b 008 c 12.50\n',
+            delta.Gone(u'one'),
+        ]
+        path = os.path.join(self.tmpdir, u'rec')
+        for _ in range(2):
+            # every run appends a new session
+            with open(path, u'ab') as fp:
+                self.assertEqual(list(delta.record_feed(iter(items), fp)), items)
+
+        def plain(item):
+            if isinstance(item, (delta.Source, delta.Gone)):
+                return type(item), item.name
+            if isinstance(item, delta.Block):
+                return item.text
+            return item
+
+        with open(path, u'rb') as fp:
+            replayed = list(delta.replay_feed(fp, markers=True, blocks=True))
+        self.assertIsInstance(replayed[1], delta.WallTime)
+        self.assertEqual([plain(item) for item in replayed if not isinstance(item, delta.WallTime)],
+                         [plain(item) for item in items] * 2)
+
+        with open(path, u'rb') as fp:
+            self.assertEqual(list(delta.replay_feed(fp))[:7], [
+                delta.separator, u'a 1 b 007 c  2.50\n', u'no numbers\n', u'nul \0 1\n', u'x 300\n', u'y 4\n',
+                delta.separator])
+
+    def test_record_block_lines(self):
+        # rows that come and go (or blocks cut anywhere) still share the
+        # skeletons of their lines
+        blocks = [delta.Block(u''.join(u'{0} {1}\n'.format(name, i) for name in u'abcdefgh'[:i]) + u'x {0}'.format(i))
+                  for i in range(1, 9)]
+        fp = BytesIO()
+        recorder = delta.Recorder(fp)
+        for block in blocks:
+            recorder.record(block)
+        recorder.close()
+        self.assertEqual(len(recorder.skeletons), 9)
+        replayed = list(delta.replay_feed(BytesIO(fp.getvalue()), blocks=True))
+        self.assertEqual([block.text for block in replayed], [block.text for block in blocks])
+
+    def test_replay_errors(self):
+        with self.assertRaises(delta.RecordingError):
+            list(delta.replay_feed(BytesIO(b'not a recording')))
+        fp = BytesIO()
+        list(delta.record_feed(iter([u'a 1\n']), fp))
+        with self.assertRaises(delta.RecordingError):
+            list(delta.replay_feed(BytesIO(fp.getvalue()[:-1])))
+
+        fp = BytesIO()
+        list(delta.record_feed(iter([delta.separator, delta.Source(u'one'), u'a 1 b 007\n', delta.Block(u'x 300\ny 4\n')]), fp))
+        data = fp.getvalue()
+        full = [repr(item) for item in delta.replay_feed(BytesIO(data), markers=True)]
+        # cut inside the separator's time and inside the source name
+        for cut in (10, 18):
+            with self.assertRaises(delta.RecordingError):
+                list(delta.replay_feed(BytesIO(data[:cut]), markers=True))
+        for cut in range(len(delta.SESSION_MAGIC), len(data)):
+            # a recording cut between two records is just shorter
+            try:
+                items = [repr(item) for item in delta.replay_feed(BytesIO(data[:cut]), markers=True)]
+            except delta.RecordingError:
+                continue
+            self.assertEqual(items, full[:len(items)])
+
+    @unittest.skipIf(asyncio is None, u'asyncio not available')
+    def test_multi_feed(self):
+        path = self.write_file(u'one', u'file 3\n')
+        feed = delta.multi_feed([(u'sleep 0.1; echo b 2',), (u'echo', u'a', u'1')], [path], 0.3, 2)
+        items = [item.name if isinstance(item, delta.Source) else item for item in feed]
+        self.assertEqual(items, [
+            delta.separator, path, u'file 3\n',
+            u'echo a 1', u'a 1\n',
+            u'sleep 0.1; echo b 2', u'b 2\n',
+            delta.separator, path, u'file 3\n',
+            u'echo a 1', u'a 1\n',
+            u'sleep 0.1; echo b 2', u'b 2\n'])
+
+    @unittest.skipIf(asyncio is None, u'asyncio not available')
+    def test_multi_feed_slow_source(self):
+        feed = delta.multi_feed([(u'sleep 0.25; echo slow',), (u'echo fast',)], [], 0.1, 3)
+        items = [item.name if isinstance(item, delta.Source) else item for item in feed]
+        self.assertEqual(items.count(u'fast\n'), 3)
+        self.assertEqual(items.count(u'slow\n'), 1)
+        self.assertEqual(items[:3], [delta.separator, u'echo fast', u'fast\n'])
+
+    def test_command_feed_blocks(self):
+        feed = delta.command_feed((u'echo a 1; echo b 2',), 0.1, 2, blocks=True)
+        items = list(feed)
+        self.assertIs(items[0], delta.separator)
+        self.assertEqual(items[1].text, u'a 1\nb 2\n')
+        self.assertIs(items[2], delta.separator)
+        self.assertEqual(len(items), 4)
+
     def test_command_feed(self):
         feed = delta.command_feed([u'/bin/echo', u'hello'], 0.1)
         self.assertIs(next(feed), delta.separator)
@@ -487,6 +1653,72 @@ class FeedTestCase(unittest.TestCase):
         self.assertEqual(next(feed), u'hello\n')
 
 
+class TestScheduler(delta.Scheduler):
+    def __init__(self, interval, overrun=u'skip', work=()):
+        super(TestScheduler, self).__init__(interval, overrun)
+        self.now = 100.0
+        self.work = list(work)
+        self.fired = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def run(self, ticks):
+        for _ in range(ticks):
+            self.wait()
+            self.fired.append(self.now)
+            if self.work:
+                self.now += self.work.pop(0)
+
+
+class SchedulerTestCase(unittest.TestCase):
+    def test_no_drift(self):
+        s = TestScheduler(1, work=[0.3] * 5)
+        s.run(5)
+        self.assertEqual(s.fired, [100.0, 101.0, 102.0, 103.0, 104.0])
+        self.assertEqual(s.jitter_max, 0)
+
+    def test_fractional(self):
+        s = TestScheduler(0.25, work=[0.1] * 3)
+        s.run(3)
+        self.assertEqual(s.fired, [100.0, 100.25, 100.5])
+
+    def test_overrun_skip(self):
+        s = TestScheduler(1, u'skip', work=[0.5, 2.5, 0.5])
+        s.run(3)
+        self.assertEqual(s.fired, [100.0, 101.0, 104.0])
+        self.assertEqual(s.skipped, 2)
+
+    def test_overrun_catch_up(self):
+        s = TestScheduler(1, u'catch-up', work=[2.5, 0, 0, 0])
+        s.run(4)
+        self.assertEqual(s.fired, [100.0, 102.5, 102.5, 103.0])
+        self.assertEqual(s.skipped, 0)
+        self.assertEqual(s.jitter_max, 1.5)
+
+    def test_zero_interval(self):
+        s = TestScheduler(0, work=[0.5, 0, 0])
+        s.run(3)
+        self.assertEqual(s.fired, [100.0, 100.5, 100.5])
+        self.assertEqual(s.skipped, 0)
+
+    def test_overrun_back_to_back(self):
+        s = TestScheduler(1, u'back-to-back', work=[2.5, 0.5, 0.5])
+        s.run(3)
+        self.assertEqual(s.fired, [100.0, 102.5, 103.5])
+
+    def test_report(self):
+        s = TestScheduler(1, u'skip', work=[1.5])
+        s.run(2)
+        self.assertEqual(s.report(), u'2 ticks, 1 skipped, jitter avg 0.000ms max 0.000ms')
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, delta.Scheduler, 1, u'sometimes')
+
+
 class UtilsTestCase(unittest.TestCase):
     def test_run(self):
         def threadfunc(wfd):
@@ -520,6 +1752,76 @@ hello  +1
         thd.join()
         rfd.close()
 
+    def test_run_blocks(self):
+        sio = StringIO()
+        feed = [delta.Block(u'a 1\nb 2\n'), delta.separator, delta.Block(u'a 3\nb 2\n')]
+        parser = delta.Parser(flex=True, absolute=False, use_colors=False)
+        printer = delta.Printer(sio, timestamps=False, separators=False, orig=False, skip_zeros=False)
+
+        delta.run(feed, parser, printer)
+        self.assertEqual(sio.getvalue(), u'''a  1
+b  2
+a +2
+b +0
+''')
+
+    def test_run_profile(self):
+        sio = StringIO()
+        feed = [delta.Block(u'a 1\nb 2\n'), delta.separator, delta.Block(u'a 3\nb 2\nnul\0 1\n'),
+                delta.separator, u'a 4\n']
+        parser = delta.Parser(flex=True, absolute=False, use_colors=False)
+        printer = delta.Printer(sio, timestamps=False, separators=False, orig=False, skip_zeros=False)
+        report = StringIO()
+        profiler = delta.Profiler(parser, report)
+
+        delta.run(profiler.instrument(feed, parser, printer), parser, printer)
+        self.assertEqual(sio.getvalue(), u'a  1\nb  2\na +2\nb +0\nnul\0  1\na +1\n')
+        self.assertEqual((profiler.ticks, profiler.hits, profiler.new), (2, 3, 3))
+
+        profiler.report()
+        self.assertTrue(report.getvalue().startswith(
+            u'delta: 2 ticks, 6 lines (3.0/tick); feed '))
+        self.assertTrue(re.search(r'parse [0-9.]+s \(3 hits [0-9.]+s, 3 new [0-9.]+s, 50\.0% hit rate\)',
+                                  report.getvalue()))
+        self.assertLessEqual(profiler.new_parse, profiler.parse)
+        self.assertIn(u'; 3 formats cached', report.getvalue())
+
+    def test_run_profile_top(self):
+        # with --top the lines are formatted when the tick ends
+        class Profiler(delta.Profiler):
+            now = 0.0
+
+            def clock(self):
+                return self.now
+
+        feed = [u'a 1\n', delta.separator, u'a 3\n']
+        parser = delta.Parser(use_colors=False)
+        printer = delta.Printer(StringIO(), timestamps=False, separators=False, orig=False, skip_zeros=False, top=1)
+        profiler = Profiler(parser, StringIO())
+        output_ranked = printer.output_ranked
+
+        def slow_output_ranked():
+            profiler.now += 10
+            output_ranked()
+
+        printer.output_ranked = slow_output_ranked
+        delta.run(profiler.instrument(feed, parser, printer), parser, printer)
+        self.assertEqual(profiler.format, 20)
+
+    @unittest.skipIf(sys.version_info[0] == 2, u'no fast path on python 2')
+    def test_fast_args(self):
+        import inspect
+        defaults = dict((name, param.default) for name, param in inspect.signature(delta.real_cli).parameters.items()
+                        if param.default is not param.empty)
+        for argv in [[], [u'echo', u'a', u'1'], [u'-n', u'1', u'-i', u'0.5', u'cat', u'/proc/vmstat'],
+                     [u'--count', u'3', u'--interval', u'0', u'date']]:
+            # the same as what click would have made of it
+            args = dict(defaults, **delta.fast_args(argv))
+            self.assertEqual(args, delta.make_cli().make_context(u'delta', list(argv)).params)
+        for argv in [[u'-n'], [u'-n', u'x'], [u'-i', u'-1', u'date'], [u'-z', u'date'], [u'ls', u'-l'],
+                     [u'--count=1', u'date'], [u'--help']]:
+            self.assertIsNone(delta.fast_args(argv))
+
     def test_use_separators(self):
         cases = {
             (u'true', u'always', False, False): True,
@@ -556,6 +1858,12 @@ hello  +1
             pass
 
 
+try:
+    import click
+except ImportError:
+    click = None
+
+
 class CliTestCase(unittest.TestCase):
 
     def test_cli_stdin(self):
@@ -600,6 +1908,83 @@ hello +0
 hello +0
 hello +0
 hello +0
+''')
+    def test_cli_files(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            paths = []
+            for name in (u'rx', u'tx'):
+                paths.append(os.path.join(tmpdir, name))
+                with open(paths[-1], u'w') as fp:
+                    fp.write(u'5\n')
+            stdout = StringIO()
+            delta.real_cli(
+                stdin=StringIO(),
+                stdout=stdout,
+                cmd=(),
+                timestamps=False,
+                interval=0.01,
+                flex=True,
+                separators=u'never',
+                color=False,
+                orig=False,
+                skip_zeros=False,
+                absolute=False,
+                count=2,
+                files=paths)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.assertEqual(stdout.getvalue(), u'''{0}:  5
+{1}:  5
+{0}: +0
+{1}: +0
+'''.format(*paths))
+
+    @unittest.skipIf(click is None, u'click not installed')
+    def test_cli_missing_file(self):
+        missing = os.path.join(tempfile.gettempdir(), u'delta-missing-file')
+        for commands in ((), (u'echo a 1',)):
+            with self.assertRaises(click.ClickException) as cm:
+                delta.real_cli(
+                    stdin=StringIO(),
+                    stdout=StringIO(),
+                    cmd=(),
+                    timestamps=False,
+                    interval=0.01,
+                    flex=True,
+                    separators=u'never',
+                    color=False,
+                    orig=False,
+                    skip_zeros=False,
+                    absolute=False,
+                    count=1,
+                    files=(__file__, missing),
+                    commands=commands)
+            self.assertIn(missing, cm.exception.message)
+
+    @unittest.skipIf(asyncio is None, u'asyncio not available')
+    def test_cli_commands(self):
+        stdout = StringIO()
+        delta.real_cli(
+            stdin=StringIO(),
+            stdout=stdout,
+            cmd=(u'echo', u'a', u'1'),
+            timestamps=False,
+            interval=0.1,
+            flex=True,
+            separators=u'never',
+            color=False,
+            orig=False,
+            skip_zeros=False,
+            absolute=False,
+            count=2,
+            commands=(u'sleep 0.05; echo a 1',))
+
+        self.assertEqual(stdout.getvalue(), u'''echo a 1: a  1
+sleep 0.05; echo a 1: a  1
+echo a 1: a +0
+sleep 0.05; echo a 1: a +0
 ''')
 
 if __name__ == '__main__':